@@ -0,0 +1,67 @@
+"""
+Batched tensor-level augmentation.
+
+Replaces the per-image PIL train/val transforms with one pass over a whole collated uint8 batch (N x H x W x C, as
+served by a materialized image store), run on the training device after the batch is moved there:
+    - Random resized crops & horizontal flips, both applied through one batched affine grid.
+    - A fused uint8 -> float normalize: x * (1 / (255 * std)) - mean / std.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugment:
+    def __init__(self, im_size, mean, std, train=True, scale=(0.5, 1.0), ratio=(3. / 4., 4. / 3.), flip_p=0.5,
+                 seed=None):
+        self.im_size = im_size
+        self.train = train
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.flip_p = flip_p
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+        # Crop & flip parameters are drawn on the CPU from a private generator, so runs are reproducible per seed.
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+    def __call__(self, batch):
+        # Channels-last uint8 batches (N, H, W, C) come straight from the store, move channels first.
+        if batch.dim() == 4 and batch.shape[-1] in (1, 3) and batch.shape[1] not in (1, 3):
+            batch = batch.permute(0, 3, 1, 2)
+        x = batch.float()
+
+        if self.train:
+            grid = F.affine_grid(self._sample_theta(x.shape[0]).to(x.device),
+                                 [x.shape[0], x.shape[1], self.im_size, self.im_size], align_corners=False)
+            x = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        elif x.shape[-2:] != (self.im_size, self.im_size):
+            x = F.interpolate(x, size=(self.im_size, self.im_size), mode='bilinear', align_corners=False)
+
+        return self._normalize(x)
+
+    def _sample_theta(self, n):
+        """One 2x3 affine matrix per sample, mapping the output grid onto a random crop of the input."""
+        area = torch.empty(n).uniform_(self.scale[0], self.scale[1], generator=self.generator)
+        ratio = torch.exp(torch.empty(n).uniform_(self.log_ratio[0], self.log_ratio[1], generator=self.generator))
+
+        # Crop width & height as fractions of the image, then a centre that keeps the crop inside it.
+        w = torch.sqrt(area * ratio).clamp(max=1.0)
+        h = torch.sqrt(area / ratio).clamp(max=1.0)
+        cx = (torch.rand(n, generator=self.generator) * 2 - 1) * (1 - w)
+        cy = (torch.rand(n, generator=self.generator) * 2 - 1) * (1 - h)
+        flip = torch.where(torch.rand(n, generator=self.generator) < self.flip_p, -torch.ones(n), torch.ones(n))
+
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = cy
+        return theta
+
+    def _normalize(self, x):
+        scale = (1.0 / (255.0 * self.std)).to(x.device)
+        shift = (self.mean / self.std).to(x.device)
+        return torch.addcmul(-shift, x, scale)
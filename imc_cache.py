@@ -0,0 +1,72 @@
+"""
+Bounded, shared-memory LRU cache of post-transform samples.
+
+All storage is preallocated in shared memory by the main process before the DataLoader starts its workers, so every
+worker (and every epoch's fresh set of workers) reads and fills the same cache. Only use it for datasets whose
+transforms are deterministic, e.g. the val_transformer of imc_main.
+NOTE: An unshuffled loader visits the split in the same order every epoch, so budget for the whole split. With less
+room, LRU evicts every entry before its next use.
+"""
+import multiprocessing
+import numpy as np
+import torch
+
+HITS, MISSES, CLOCK = 0, 1, 2
+
+
+class SharedLRUCache:
+    def __init__(self, num_items, sample_shape, dtype=torch.float32, max_bytes=1024 ** 3):
+        slot_bytes = int(np.prod(sample_shape)) * torch.empty((), dtype=dtype).element_size()
+        self.capacity = int(min(num_items, max_bytes // slot_bytes))
+        if self.capacity < 1:
+            raise ValueError('Cache budget of ' + str(max_bytes) + ' bytes is smaller than one sample.')
+
+        self.data = torch.empty((self.capacity,) + tuple(sample_shape), dtype=dtype).share_memory_()
+        self.labels = torch.zeros(self.capacity, dtype=torch.int64).share_memory_()
+        self.key_of = torch.full((self.capacity,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(self.capacity, dtype=torch.int64).share_memory_()
+        self.slot_of = torch.full((num_items,), -1, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = multiprocessing.Lock()
+
+    def get(self, idx):
+        """Returns (image, label) for a cached index, or None."""
+        with self.lock:
+            slot = int(self.slot_of[idx])
+            if slot < 0:
+                self.counters[MISSES] += 1
+                return None
+            self.counters[HITS] += 1
+            self.counters[CLOCK] += 1
+            self.last_used[slot] = self.counters[CLOCK]
+
+            # Cloned while locked, as another worker may evict & overwrite the slot right after.
+            return self.data[slot].clone(), int(self.labels[slot])
+
+    def put(self, idx, image, label):
+        with self.lock:
+            if self.slot_of[idx] >= 0:
+                return
+
+            # Take a free slot first, otherwise evict the least recently used one.
+            free = (self.key_of < 0).nonzero()
+            slot = int(free[0]) if len(free) else int(torch.argmin(self.last_used))
+            old_key = int(self.key_of[slot])
+            if old_key >= 0:
+                self.slot_of[old_key] = -1
+
+            self.data[slot].copy_(image)
+            self.labels[slot] = label
+            self.key_of[slot] = idx
+            self.slot_of[idx] = slot
+            self.counters[CLOCK] += 1
+            self.last_used[slot] = self.counters[CLOCK]
+
+    def stats(self):
+        hits, misses = int(self.counters[HITS]), int(self.counters[MISSES])
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / max(hits + misses, 1),
+                'size': int((self.key_of >= 0).sum()),
+                'capacity': self.capacity,
+                'bytes': self.data.numel() * self.data.element_size()}
@@ -0,0 +1,84 @@
+"""
+Shared-memory batch ring for the DataLoader collate path.
+
+The default path has every worker build a fresh batch tensor with default_collate and send it to the main process
+through a queue. RingLoader instead preallocates a ring of batch buffers in shared memory before the workers start.
+Each worker writes its samples straight into the slot of the batch it was given and only returns the slot number,
+and the main process hands out views of that slot, so the batch is never copied or pickled.
+
+A slot is reused num_slots batches later. The DataLoader never has more than num_workers * prefetch_factor batches
+in flight, so a ring of that size + 2 never overwrites the batch the training loop is still working on.
+"""
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
+
+
+class BatchRing:
+    def __init__(self, num_slots, batch_size, sample_shape, dtype=torch.float32):
+        self.num_slots = num_slots
+        self.images = torch.empty((num_slots, batch_size) + tuple(sample_shape), dtype=dtype).share_memory_()
+        self.labels = torch.zeros((num_slots, batch_size), dtype=torch.int64).share_memory_()
+
+
+class RingBatchSampler(Sampler):
+    """Yields (batch number, sample indices), so each worker knows which ring slot to fill."""
+    def __init__(self, sampler, batch_size, drop_last=False):
+        self.batches = BatchSampler(sampler, batch_size, drop_last)
+
+    def __iter__(self):
+        for n, indices in enumerate(self.batches):
+            yield n, indices
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class RingDataset(Dataset):
+    def __init__(self, dataset, ring):
+        self.dataset = dataset
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        n, indices = key
+        slot = n % self.ring.num_slots
+        for i, idx in enumerate(indices):
+            data = self.dataset[idx]
+            image = torch.as_tensor(data['img'])
+            assert image.shape == self.ring.images.shape[2:], 'Sample ' + str(idx) + ' has shape ' + \
+                str(tuple(image.shape)) + ', the ring slots hold ' + str(tuple(self.ring.images.shape[2:]))
+            self.ring.images[slot, i].copy_(image)
+            self.ring.labels[slot, i] = data['label']
+        return slot, len(indices)
+
+
+def _no_collate(key):
+    return key
+
+
+class RingLoader:
+    def __init__(self, dataset, batch_size=8, shuffle=False, drop_last=False, num_workers=0, prefetch_factor=2):
+        sample = dataset[0]['img']
+        if not (torch.is_tensor(sample) or isinstance(sample, np.ndarray)):
+            raise ValueError('RingLoader needs tensor or ndarray samples, got ' + type(sample).__name__ +
+                             ': give the dataset a transform ending in ToTensor().')
+        sample = torch.as_tensor(sample)
+        num_slots = max(num_workers, 1) * prefetch_factor + 2
+        self.ring = BatchRing(num_slots, batch_size, sample.shape, dtype=sample.dtype)
+
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+        self.loader = DataLoader(RingDataset(dataset, self.ring), batch_size=None,
+                                 sampler=RingBatchSampler(sampler, batch_size, drop_last),
+                                 collate_fn=_no_collate, num_workers=num_workers, **kwargs)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for slot, count in self.loader:
+            yield {'img': self.ring.images[slot, :count],
+                   'label': self.ring.labels[slot, :count]}
@@ -1,5 +1,7 @@
 
 import os
+import json
+import struct
 from torch.utils.data import Dataset, DataLoader
 import torch
 import torch.nn as nn
@@ -10,6 +12,10 @@ import numpy as np
 
 from sklearn.metrics import classification_report, roc_auc_score, roc_curve, confusion_matrix
 
+from imc_decode import get_decoder
+from imc_store import ImageStore, materialize, store_exists
+from imc_cache import SharedLRUCache
+
 
 # HELPER FUNCTION
 def read_txt(txt_path):
@@ -19,50 +25,211 @@ def read_txt(txt_path):
     return txt_data
 
 
+# =============================================================
+# NOTE MANIFEST
+# =============================================================
+class Manifest:
+    """
+    Compact (path, label) listing for a dataset split.
+    All paths live in one packed utf-8 buffer addressed by an offsets array, and labels are a uint8 array, so a
+    forked DataLoader worker touches a handful of NumPy objects instead of 115k Python lists.
+    A saved manifest records the key() of the split files it was built from, so edited split files (or a moved root)
+    are noticed and the manifest rebuilt.
+    """
+    MAGIC = b'CTMANIF2'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, paths, offsets, labels):
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_split_files(cls, root_dir, classes, files_path, is_ctx=False):
+        encoded, labels = [], []
+        for cls_index in range(len(classes)):
+            folder = root_dir if is_ctx else os.path.join(root_dir, classes[cls_index])
+            for x in read_txt(files_path[cls_index]):
+                encoded.append(os.path.join(folder, x).encode('utf-8'))
+                labels.append(cls_index)
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        paths = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(paths, offsets, np.asarray(labels, dtype=np.uint8))
+
+    @staticmethod
+    def key(root_dir, classes, files_path, is_ctx=False):
+        """What a manifest is built from: the root, classes & each split file's size and mtime_ns."""
+        files = []
+        for path in files_path:
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        return {'root': os.path.abspath(root_dir), 'classes': list(classes), 'is_ctx': bool(is_ctx), 'files': files}
+
+    @classmethod
+    def read_key(cls, index_file):
+        """The key an index file was saved with, or None for a missing, older or unreadable one."""
+        try:
+            with open(index_file, 'rb') as f:
+                magic, _, _, key_len = cls.HEADER.unpack(f.read(cls.HEADER.size))
+                if magic != cls.MAGIC:
+                    return None
+                return json.loads(f.read(key_len).decode('utf-8'))
+        except (OSError, ValueError, struct.error):
+            return None
+
+    @classmethod
+    def load(cls, index_file):
+        """Maps an index file written by save(), no parsing is done so this is O(1) in the number of images."""
+        with open(index_file, 'rb') as f:
+            magic, num_ims, buf_len, key_len = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        if magic != cls.MAGIC:
+            raise ValueError('Not a CTDataset manifest: ' + str(index_file))
+
+        start = cls.HEADER.size + key_len
+        offsets = np.memmap(index_file, dtype=np.int64, mode='r', offset=start, shape=(num_ims + 1,))
+        start += offsets.nbytes
+        labels = np.memmap(index_file, dtype=np.uint8, mode='r', offset=start, shape=(num_ims,))
+        start += labels.nbytes
+        paths = np.memmap(index_file, dtype=np.uint8, mode='r', offset=start, shape=(buf_len,))
+        return cls(paths, offsets, labels)
+
+    def save(self, index_file, key=None):
+        # The JSON key is space-padded to a multiple of 8 bytes, which keeps the arrays after it aligned.
+        key = json.dumps(key).encode('utf-8')
+        key += b' ' * (-len(key) % 8)
+        with open(index_file + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self), len(self.paths), len(key)))
+            f.write(key)
+            f.write(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+            f.write(np.ascontiguousarray(self.labels, dtype=np.uint8).tobytes())
+            f.write(np.ascontiguousarray(self.paths, dtype=np.uint8).tobytes())
+        os.replace(index_file + '.tmp', index_file)
+
+    def path(self, idx):
+        return self.paths[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def label(self, idx):
+        return int(self.labels[idx])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return self.path(idx), self.label(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
 # =============================================================
 # NOTE DATASET CLASS
 # =============================================================
 class CTDataset(Dataset):
-    def __init__(self, root_dir, classes="", covid_files="", non_covid_files="", transform=None, is_ctx=False):
+    def __init__(self, root_dir, classes="", covid_files="", non_covid_files="", transform=None, is_ctx=False,
+                 store=None, store_split=None, index_file=None, decoder='pil', decode_size=None, channels=3):
         self.root_dir = root_dir
         self.classes = classes
         self.files_path = [non_covid_files, covid_files]
-        self.image_list = []
+        self.manifest = None
         self.transform = transform
+        self.store = None
+        self.cache = None
+        self.decoder = decoder
+        self.decode = get_decoder(decoder)
+        self.decode_size = decode_size      # NOTE: Set to IMGSIZE to decode JPEGs at reduced resolution.
+        self.channels = channels
+        self.mode = 'L' if channels == 1 else 'RGB'
 
-        # read the files from data split text files
-        covid_files = read_txt(covid_files)
-        non_covid_files = read_txt(non_covid_files)
+        # Serve pre-decoded images from a materialized store (see imc_store.py) instead of the image files.
+        if store is not None:
+            self.store = ImageStore(store, split=store_split)
+            return
 
-        for cls_index in range(len(self.classes)):
-            if is_ctx:
-                class_files = [[os.path.join(self.root_dir, x), cls_index] for x in read_txt(self.files_path[cls_index])]
-            else:
-                class_files = [[os.path.join(self.root_dir, self.classes[cls_index], x), cls_index] for x in read_txt(
-                    self.files_path[cls_index])]
-            self.image_list += class_files
+        # Read the files from data split text files, or re-use a saved manifest built from the same split files.
+        key = None if index_file is None else Manifest.key(self.root_dir, self.classes, self.files_path, is_ctx=is_ctx)
+        if index_file is not None and Manifest.read_key(index_file) == key:
+            self.manifest = Manifest.load(index_file)
+        else:
+            self.manifest = Manifest.from_split_files(self.root_dir, self.classes, self.files_path, is_ctx=is_ctx)
+            if index_file is not None:
+                self.manifest.save(index_file, key=key)
 
     def __len__(self):
-        return len(self.image_list)
+        if self.store is not None:
+            return len(self.store)
+        return len(self.manifest)
 
     def __getitem__(self, idx):
-        path = self.image_list[idx][0]
+        if self.cache is not None:
+            return self._get_cached(idx)
+        return self._load(idx)
+
+    def _load(self, idx):
+        if self.store is not None:
+            return self._get_stored(idx)
+
+        path, label = self.manifest[idx]
 
         # Read the image
-        image = Image.open(path).convert('RGB')     # For jpeg images
+        image = self.decode(path, size=self.decode_size, mode=self.mode)
 
         # Apply transforms
         if self.transform:
             image = self.transform(image)
 
-        label = int(self.image_list[idx][1])
-
         data = {'img': image,
                 'label': label}
                 # 'paths': path}      # NOTE: Comment this line & compute_metrics out for fit_routine
 
         return data
 
+    def _get_stored(self, idx):
+        image, label = self.store[idx]
+
+        # PIL transforms still work on stored images, without a transform the uint8 HxWxC view is served as-is.
+        if self.transform:
+            image = self.transform(Image.fromarray(image.squeeze(-1) if image.shape[-1] == 1 else image))
+        else:
+            image = torch.from_numpy(image)
+
+        data = {'img': image,
+                'label': label}
+
+        return data
+
+    def _get_cached(self, idx):
+        cached = self.cache.get(idx)
+        if cached is not None:
+            return {'img': cached[0],
+                    'label': cached[1]}
+
+        data = self._load(idx)
+        self.cache.put(idx, data['img'], data['label'])
+        return data
+
+    def enable_cache(self, max_bytes=1024 ** 3):
+        """Keeps post-transform samples in a shared-memory LRU cache. NOTE: Only for deterministic transforms!"""
+        sample = self._load(0)['img']
+        if not torch.is_tensor(sample):
+            raise ValueError('Only tensor samples can be cached, give the dataset a transform ending in ToTensor().')
+        self.cache = SharedLRUCache(len(self), sample.shape, dtype=sample.dtype, max_bytes=max_bytes)
+        return self
+
+    def materialize(self, store_dir, im_size=256):
+        """Decodes this dataset once into store_dir, after which it is served from the store."""
+        if not store_exists(store_dir):
+            materialize(self.manifest, store_dir, im_size=im_size, decoder=self.decoder, channels=self.channels,
+                        class_names=self.classes)
+        return self.open_store(store_dir)
+
+    def open_store(self, store_dir, split=None):
+        """Serves this dataset from an existing store, or one split of it."""
+        self.store = ImageStore(store_dir, split=split)
+        return self
+
 
 # =============================================================
 # Former Metrics Method (For Old_Main)
@@ -0,0 +1,173 @@
+"""
+Pluggable image decoders for the CT datasets.
+
+Every decoder takes a file path (or the encoded bytes of a file) and returns an RGB or grayscale PIL image. When a
+size is given, JPEGs are decoded with DCT scaling straight to the smallest 1/2, 1/4 or 1/8 scale whose shorter
+side still covers that size, instead of decoding at full resolution and shrinking afterwards. Other formats are
+decoded at full resolution.
+
+Run this file directly to benchmark every installed backend on a data split:
+    python imc_decode.py data/ct_ctx/2A_images data/ct_ctx/co_train.txt --size 256
+"""
+import io
+import os
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+# Optional backends
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_GRAY
+except ImportError:
+    TurboJPEG = None
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+JPEG_MAGIC = b'\xff\xd8'
+SCALES = (8, 4, 2)
+DECODERS = {}
+
+
+def register(name):
+    def wrapper(func):
+        DECODERS[name] = func
+        return func
+    return wrapper
+
+
+def get_decoder(name):
+    if name not in DECODERS:
+        raise ValueError('Unknown decoder "' + str(name) + '", choose from: ' + ', '.join(DECODERS))
+    if name not in available_decoders():
+        raise ValueError('Decoder "' + name + '" is not installed.')
+    return DECODERS[name]
+
+
+def available_decoders():
+    names = ['pil']
+    if TurboJPEG is not None:
+        names.append('turbojpeg')
+    if cv2 is not None:
+        names.append('opencv')
+    return names
+
+
+def decode(src, size=None, mode='RGB', decoder='pil'):
+    return get_decoder(decoder)(src, size=size, mode=mode)
+
+
+# =============================================================
+# NOTE HELPERS
+# =============================================================
+def _read_bytes(src):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return bytes(src)
+    with open(src, 'rb') as f:
+        return f.read()
+
+
+def _reduction(width, height, size):
+    """Largest JPEG scale denominator that keeps the shorter side at or above size."""
+    if size:
+        for denom in SCALES:
+            if min(width, height) // denom >= size:
+                return denom
+    return 1
+
+
+# =============================================================
+# NOTE BACKENDS
+# =============================================================
+@register('pil')
+def decode_pil(src, size=None, mode='RGB'):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        src = io.BytesIO(src)
+    image = Image.open(src)
+
+    # draft() only has an effect on JPEGs, where it sets up DCT scaling before any pixel is decoded.
+    if size:
+        image.draft(mode, (size, size))
+    return image.convert(mode)
+
+
+_turbo = None
+
+
+@register('turbojpeg')
+def decode_turbojpeg(src, size=None, mode='RGB'):
+    global _turbo
+    data = _read_bytes(src)
+    if not data.startswith(JPEG_MAGIC):
+        return decode_pil(data, size=size, mode=mode)
+
+    # Loading libjpeg-turbo is per process, so it happens lazily inside each DataLoader worker.
+    if _turbo is None:
+        _turbo = TurboJPEG()
+    width, height, _, _ = _turbo.decode_header(data)
+    denom = _reduction(width, height, size)
+    pixels = _turbo.decode(data, pixel_format=TJPF_GRAY if mode == 'L' else TJPF_RGB, scaling_factor=(1, denom))
+    return Image.fromarray(pixels.squeeze(-1) if pixels.ndim == 3 and pixels.shape[-1] == 1 else pixels)
+
+
+@register('opencv')
+def decode_opencv(src, size=None, mode='RGB'):
+    data = np.frombuffer(_read_bytes(src), dtype=np.uint8)
+    gray = mode == 'L'
+
+    flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+    if size and data[:2].tobytes() == JPEG_MAGIC:
+        width, height = Image.open(io.BytesIO(data.tobytes())).size
+        denom = _reduction(width, height, size)
+        if denom > 1:
+            flags = getattr(cv2, 'IMREAD_REDUCED_' + ('GRAYSCALE_' if gray else 'COLOR_') + str(denom))
+
+    pixels = cv2.imdecode(data, flags)
+    if not gray:
+        pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(pixels)
+
+
+# =============================================================
+# NOTE MICRO-BENCHMARK
+# =============================================================
+def benchmark(paths, size=None, mode='RGB', decoders=None):
+    """Returns {decoder: images/sec} over paths. Files are read into memory first so only decoding is timed."""
+    blobs = [_read_bytes(p) for p in paths]
+    results = {}
+    for name in decoders or available_decoders():
+        func = get_decoder(name)
+        func(blobs[0], size=size, mode=mode)        # Warm-up
+        start = time.perf_counter()
+        for blob in blobs:
+            func(blob, size=size, mode=mode)
+        results[name] = len(blobs) / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == '__main__':
+    from imc_dataset import read_txt
+
+    parser = argparse.ArgumentParser(description='Report decoded images/sec for every installed decoder.')
+    parser.add_argument('root_dir', help="Image folder, e.g. data/ct_ctx/2A_images")
+    parser.add_argument('split_file', help="Split file listing images in root_dir, e.g. co_train.txt")
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--limit', type=int, default=500)
+    parser.add_argument('--gray', action='store_true')
+    args = parser.parse_args()
+
+    files = [os.path.join(args.root_dir, x) for x in read_txt(args.split_file)[:args.limit]]
+    divider = '===================================================='
+    print(divider)
+    print('IMAGES:\t\t\t', '{:,}'.format(len(files)))
+    print('TARGET SIZE:\t', args.size)
+    print(divider)
+    for target in (None, args.size):
+        rates = benchmark(files, size=target, mode='L' if args.gray else 'RGB')
+        for name, rate in rates.items():
+            label = name + (' (scaled)' if target else ' (full)')
+            print('{:<20}\t{:>9.1f} img/s'.format(label, rate))
+    print(divider)
@@ -13,16 +13,19 @@ device = torch.device('cuda')
 
 
 def fit(model, train_loader, test_loader, optimizer, epochs=10, criterion=torch.nn.CrossEntropyLoss(), best_acc=0.0,
-        print_freq=10, save_model=True, save_params=True, quant=False, sub_folder='', model_name='Empty', divider=''):
+        print_freq=10, save_model=True, save_params=True, quant=False, sub_folder='', model_name='Empty', divider='',
+        train_transform=None, test_transform=None):
 
     global device
     device = torch.device('cpu') if quant else torch.device('cuda')
     for epoch in range(epochs):
         adjust_learning_rate(optimizer, epochs)
         acc_train = train(model=model, model_name=model_name, train_loader=train_loader, optimizer=optimizer,
-                          epochs=epoch, criterion=criterion, print_freq=print_freq, quant=quant, divider=divider)
+                          epochs=epoch, criterion=criterion, print_freq=print_freq, quant=quant, divider=divider,
+                          transform=train_transform)
         acc_test = test(model=model, model_name=model_name, test_loader=test_loader,
-                        epoch=epoch, print_freq=print_freq, divider=divider, re_test=False, quant=quant)
+                        epoch=epoch, print_freq=print_freq, divider=divider, re_test=False, quant=quant,
+                        transform=test_transform)
 
         if acc_test > best_acc:
             if save_model:
@@ -39,7 +42,7 @@ def fit(model, train_loader, test_loader, optimizer, epochs=10, criterion=torch.
 
 
 def train(model=None, train_loader=None, optimizer=None, epochs=1, model_name='',
-          criterion=nn.CrossEntropyLoss(), quant=False, print_freq=10, divider=''):
+          criterion=nn.CrossEntropyLoss(), quant=False, print_freq=10, divider='', transform=None):
 
     path = pathlib.Path('logs/train_logger/')
     try:
@@ -83,6 +86,8 @@ def train(model=None, train_loader=None, optimizer=None, epochs=1, model_name=''
         batch, label = x['img'], x['label']
         batch = batch.to(device)
         label = label.to(device)
+        if transform is not None:
+            batch = transform(batch)     # Batched, on-device augmentation (see imc_augment.py)
 
         output = model(batch)
         loss = criterion(output, label)
@@ -120,7 +125,7 @@ def train(model=None, train_loader=None, optimizer=None, epochs=1, model_name=''
 
 
 def test(model=None, test_loader=None, model_name='', epoch=0, criterion=torch.nn.CrossEntropyLoss(),
-         print_freq=10, divider='', re_test=False, quant=False):
+         print_freq=10, divider='', re_test=False, quant=False, transform=None):
 
     path = pathlib.Path('logs/test_logger/')
     try:
@@ -162,6 +167,8 @@ def test(model=None, test_loader=None, model_name='', epoch=0, criterion=torch.n
         batch, label = x['img'], x['label']
         batch = batch.to(device)
         label = label.to(device)
+        if transform is not None:
+            batch = transform(batch)     # Batched, on-device augmentation (see imc_augment.py)
 
         output = model(batch)
         loss = criterion(output, label)
@@ -15,8 +15,13 @@ import math
 from imc_fit import *
 from imc_plot_run import *
 from imc_dataset import CTDataset
+from imc_shards import ShardDataset, pack_shards, shards_exist
+from imc_augment import BatchAugment
+from imc_collate import RingLoader
+from imc_store import materialize_splits, store_exists
 from imc_prune import prune_model
 from imc_prune import quantize_model
+from imc_prune import fold_to_grayscale
 from torchsummary import summary
 
 # Imported models
@@ -34,6 +39,8 @@ dir_models_pq = 'C:/Users/elite/PycharmProjects/Pytorch/imc_models/pruned_quanti
 cut_dir = 'C:/Users/elite/PycharmProjects/Pytorch'
 dir_orig = 'C:/Users/elite/PycharmProjects/Pytorch/data/covct/'
 dir_ctx = 'C:/Users/elite/PycharmProjects/Pytorch/data/ct_ctx/'
+dir_store = 'C:/Users/elite/PycharmProjects/Pytorch/data/store/'
+dir_shards = 'C:/Users/elite/PycharmProjects/Pytorch/data/ct_ctx/shards/'
 
 warnings.filterwarnings("ignore")
 random.seed(12)
@@ -59,6 +66,24 @@ params = [False, False, True, True]         # Pruning & Quantizing
 training, graph, prune, quant = params[0], params[1], params[2], params[3]
 batchsize = 8       # Chosen for the GPU: RTX 2060
 
+# Whether images are decoded once into a memory-mapped store (imc_store.py) and served from there.
+use_store = False
+# Image decoder backend ('pil', 'turbojpeg' or 'opencv'), and whether JPEGs are decoded close to IMGSIZE.
+decoder = 'pil'
+fast_decode = False
+# Whether augmentation runs on whole uint8 batches on the device (imc_augment.py). NOTE: Serves from the store.
+batch_augment = False
+use_store = use_store or batch_augment
+# Byte budget of the shared-memory LRU cache of transformed test images, 0 disables it (imc_cache.py).
+cache_eval_bytes = 0
+# Whether workers write batches straight into a ring of shared-memory buffers instead of collating (imc_collate.py).
+ring_collate = False
+# Whether CT slices are kept single-channel end to end (dataset, normalization and the model's first layer).
+grayscale = False
+CHANNELS = 1 if grayscale else 3
+# Whether the COVIDx training split is streamed from sequential-read tar shards (imc_shards.py).
+use_shards = False
+
 # Loading a pretrained model
 if not training:
     model = torch.load(dir_models + model_name + ".pth")
@@ -76,7 +101,11 @@ elif '_c' in model_name:
     SET_NAME = "COVIDx CT-1"            # Contains 115,837 images.    (Set C)
 
 if "naber" in model_name and training and 'ucsd' not in SET_NAME.lower():
-    model = NaberNet(1 if 'sars' in SET_NAME.lower() else 2)
+    model = NaberNet(1 if 'sars' in SET_NAME.lower() else 2, in_channels=CHANNELS)
+
+# Grayscale input: existing RGB first layers are folded into single-channel ones (no-op for 1-channel models).
+if grayscale:
+    model = fold_to_grayscale(model)
 
 # =============================================================
 # SELECT: Optimizer and learning rate.
@@ -91,19 +120,19 @@ if "ucsd" in SET_NAME.lower():
     CLASSES = ['UCSD_NC', 'UCSD_CO']
     IMGSIZE = 256
     EPOCHS = 10
-    normalize = transforms.Normalize(mean=0.6292, std=0.3024)
+    normalize = transforms.Normalize(mean=[0.6292] * CHANNELS, std=[0.3024] * CHANNELS)
 elif "sars" in SET_NAME.lower():
     CLASSES = ['SARSCT_NC', 'SARSCT_CO']
     IMGSIZE = 256
     EPOCHS = 20
-    normalize = transforms.Normalize(mean=0.611, std=0.273)
+    normalize = transforms.Normalize(mean=[0.611] * CHANNELS, std=[0.273] * CHANNELS)
 elif "covidx" in SET_NAME.lower():
     CLASSES = ['CTX_NC', 'CTX_CO']
     IMGSIZE = 256
     EPOCHS = 10
-    normalize = transforms.Normalize(mean=0.611, std=0.273)
+    normalize = transforms.Normalize(mean=[0.611] * CHANNELS, std=[0.273] * CHANNELS)
 
-# print(summary(model=model, input_size=(3, IMGSIZE, IMGSIZE), device='cuda'))
+# print(summary(model=model, input_size=(CHANNELS, IMGSIZE, IMGSIZE), device='cuda'))
 # sys.exit(0)
 
 # =============================================================
@@ -122,60 +151,114 @@ val_transformer = transforms.Compose([
     normalize
 ])
 
+# Batched augmentation: datasets serve raw uint8 images, crops/flips/normalize happen per batch after collation.
+train_augment, val_augment = None, None
+if batch_augment:
+    train_augment = BatchAugment(IMGSIZE, normalize.mean, normalize.std, train=True, seed=12)
+    val_augment = BatchAugment(IMGSIZE, normalize.mean, normalize.std, train=False)
+    train_transformer, val_transformer = None, None
+
 # =============================================================
 # STEP: GENERATE DATASETS
 # =============================================================
+decode_args = {'decoder': decoder, 'decode_size': IMGSIZE if fast_decode else None, 'channels': CHANNELS}
+
 if "UCSD" in SET_NAME:
     trainset = CTDataset(root_dir=dir_orig,
                          classes=CLASSES,
                          covid_files=dir_orig + 'Data-split/COVID/old_split/trainCT_COVID.txt',
                          non_covid_files=dir_orig + 'Data-split/NonCOVID/old_split/trainCT_NonCOVID.txt',
-                         transform=train_transformer)
+                         transform=train_transformer,
+                         **decode_args)
     valset = CTDataset(root_dir=dir_orig,
                        classes=CLASSES,
                        covid_files=dir_orig + 'Data-split/COVID/old_split/valCT_COVID.txt',
                        non_covid_files=dir_orig + 'Data-split/NonCOVID/old_split/valCT_NonCOVID.txt',
-                       transform=val_transformer)
+                       transform=val_transformer,
+                       **decode_args)
     testset = CTDataset(root_dir=dir_orig,
                         classes=CLASSES,
                         covid_files=dir_orig + 'Data-split/COVID/old_split/testCT_COVID.txt',
                         non_covid_files=dir_orig + 'Data-split/NonCOVID/old_split/testCT_NonCOVID.txt',
-                        transform=val_transformer)
+                        transform=val_transformer,
+                        **decode_args)
 elif "SARS" in SET_NAME:
     trainset = CTDataset(root_dir=dir_orig,
                          classes=CLASSES,
                          covid_files=dir_orig + 'Data-split/COVID/sarsct_co_train.txt',
                          non_covid_files=dir_orig + 'Data-split/NonCOVID/sarsct_nc_train.txt',
-                         transform=train_transformer)
+                         transform=train_transformer,
+                         **decode_args)
     testset = CTDataset(root_dir=dir_orig,
                         classes=CLASSES,
                         covid_files=dir_orig + 'Data-split/COVID/sarsct_co_test.txt',
                         non_covid_files=dir_orig + 'Data-split/NonCOVID/sarsct_nc_test.txt',
-                        transform=val_transformer)
+                        transform=val_transformer,
+                        **decode_args)
 elif "COVIDx" in SET_NAME:
     trainset = CTDataset(root_dir=dir_ctx + '2A_images',
                          classes=CLASSES,
                          covid_files=dir_ctx + 'co_train.txt',
                          non_covid_files=dir_ctx + 'nc_train.txt',
                          transform=train_transformer,
-                         is_ctx=True)
+                         is_ctx=True,
+                         index_file=dir_ctx + 'train.idx',
+                         **decode_args)
     valset = CTDataset(root_dir=dir_ctx + '2A_images',
                        classes=CLASSES,
                        covid_files=dir_ctx + 'co_val.txt',
                        non_covid_files=dir_ctx + 'nc_val.txt',
-                       transform=val_transformer)
+                       transform=val_transformer,
+                       is_ctx=True,
+                       index_file=dir_ctx + 'val.idx',
+                       **decode_args)
     testset = CTDataset(root_dir=dir_ctx + '2A_images',
                         classes=CLASSES,
                         covid_files=dir_ctx + 'co_test.txt',
                         non_covid_files=dir_ctx + 'nc_test.txt',
                         transform=val_transformer,
-                        is_ctx=True)
+                        is_ctx=True,
+                        index_file=dir_ctx + 'test.idx',
+                        **decode_args)
+
+# =============================================================
+# STEP: MATERIALIZE DATASETS (One-time decode)
+# =============================================================
+# NOTE: One store per dataset & image size, with every split in it. keras_run can read the same store.
+if use_store:
+    store_dir = dir_store + SET_NAME.replace(' ', '_') + '_' + str(IMGSIZE) + ('_gray' if grayscale else '')
+    store_splits = {'train': trainset, 'test': testset}
+    if 'valset' in locals():
+        store_splits['val'] = valset
+    if not store_exists(store_dir):
+        materialize_splits({name: ds.manifest for name, ds in store_splits.items()}, store_dir, im_size=IMGSIZE,
+                           decoder=decoder, channels=CHANNELS, class_names=CLASSES)
+    for name, ds in store_splits.items():
+        ds.open_store(store_dir, split=name)
+
+# NOTE: Shards hold encoded images, so they are skipped when batches are augmented from the store.
+if use_shards and not batch_augment and "COVIDx" in SET_NAME:
+    if not shards_exist(dir_shards + 'train'):
+        pack_shards(trainset.manifest, dir_shards + 'train')
+    trainset = ShardDataset(dir_shards + 'train', transform=train_transformer, **decode_args)
+
+# Validation re-runs after every epoch with deterministic transforms, so its tensors are cached after the first pass.
+if cache_eval_bytes:
+    testset.enable_cache(max_bytes=cache_eval_bytes)
 
 # =============================================================
 # STEP: CREATE DATA-LOADERS
 # =============================================================
-train_loader = DataLoader(trainset, batch_size=batchsize, drop_last=False, shuffle=True, num_workers=1)
-test_loader = DataLoader(testset, batch_size=batchsize, drop_last=False, shuffle=False, num_workers=1)
+# NOTE: Shard datasets shuffle themselves, the DataLoader must not.
+if ring_collate and not isinstance(trainset, ShardDataset):
+    train_loader = RingLoader(trainset, batch_size=batchsize, drop_last=False, shuffle=True, num_workers=1)
+else:
+    train_loader = DataLoader(trainset, batch_size=batchsize, drop_last=False,
+                              shuffle=not isinstance(trainset, ShardDataset), num_workers=1)
+if ring_collate:
+    test_loader = RingLoader(testset, batch_size=batchsize, drop_last=False, shuffle=False, num_workers=1)
+else:
+    test_loader = DataLoader(testset, batch_size=batchsize, drop_last=False, shuffle=False, num_workers=1)
 
 # =============================================================
 # STEP: MAIN FUNCTION
@@ -236,10 +319,13 @@ if __name__ == '__main__':
 
         fit(model=model, train_loader=train_loader, test_loader=test_loader, optimizer=optimizer,
             epochs=EPOCHS, model_name=model_name, divider=divider, print_freq=math.pow(10, digits),
-            sub_folder=dir_models.replace(cut_dir, ''))
+            sub_folder=dir_models.replace(cut_dir, ''), train_transform=train_augment, test_transform=val_augment)
         print("\n> All Epochs completed!")
+        if testset.cache is not None:
+            print("> Eval Cache:\t\t\t", testset.cache.stats())
     else:
-        acc_original = test(model=model, model_name=model_name, test_loader=test_loader, divider=divider, re_test=True)
+        acc_original = test(model=model, model_name=model_name, test_loader=test_loader, divider=divider, re_test=True,
+                            transform=val_augment)
         print(divider)
         acc1 = '{:.1f}%'.format(acc_original)
         print("\n> Testing Complete:\t\t\t ", '{:>6}'.format(acc1))
@@ -253,18 +339,19 @@ if __name__ == '__main__':
 
         # STEP Prune Model
         # =============================================================
-        model_pruned = prune_model(model=model, name=model_name, dir_models=dir_models_p, suffix=tag, im_size=IMGSIZE)
+        model_pruned = prune_model(model=model, name=model_name, dir_models=dir_models_p, suffix=tag, im_size=IMGSIZE,
+                                   in_ch=CHANNELS)
         model_name += tag
 
         # EVAL Pruned Model
         # =============================================================
         fit(model=model_pruned, train_loader=train_loader, test_loader=test_loader, optimizer=optimizer,
             epochs=epochs, model_name=model_name, divider=divider, print_freq=math.pow(10, digits),
-            sub_folder=dir_models_p.replace(cut_dir, ''))
+            sub_folder=dir_models_p.replace(cut_dir, ''), train_transform=train_augment, test_transform=val_augment)
 
         model_pruned = torch.load(dir_models_p + model_name + ".pth")
         acc_pruned = test(model=model_pruned, model_name=model_name, test_loader=test_loader,
-                          divider=divider, re_test=True)
+                          divider=divider, re_test=True, transform=val_augment)
 
         print(divider)
         acc1 = '{:.1f}%'.format(acc_original)
@@ -290,7 +377,7 @@ if __name__ == '__main__':
         # EVAL Quantized Model
         # =============================================================
         acc_quantized = test(model=model_quantized, model_name=model_name, test_loader=test_loader,
-                             divider=divider, re_test=True, quant=quant)
+                             divider=divider, re_test=True, quant=quant, transform=val_augment)
 
         print(divider)
         acc1 = '{:.1f}%'.format(acc_original)
@@ -20,12 +20,12 @@ IMF = [59, 59, 59]
 # NOTE MODEL CREATION
 # =============================================================
 class NaberNet(nn.Module):
-    def __init__(self, group=0):        # NOTE: Don't forget to give a group number!
+    def __init__(self, group=0, in_channels=3):        # NOTE: Don't forget to give a group number!
         super(NaberNet, self).__init__()
         self.pool = nn.MaxPool2d(2, 2)
         self.IMF = IMF[group]
 
-        self.conv1 = nn.Conv2d(3, cdims[0], 3)
+        self.conv1 = nn.Conv2d(in_channels, cdims[0], 3)
         self.conv2 = nn.Conv2d(cdims[0], cdims[1], 3)
         self.conv3 = nn.Conv2d(cdims[1], cdims[2], 3)
         self.conv4 = nn.Conv2d(cdims[2], cdims[3], 3)
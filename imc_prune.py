@@ -15,13 +15,13 @@ warnings.filterwarnings("ignore")
 device = torch.device('cuda')
 
 
-def prune_model(name='', model=None, dir_models='', suffix='_pruned', im_size=224):
+def prune_model(name='', model=None, dir_models='', suffix='_pruned', im_size=224, in_ch=3):
     print('\nPruning Model: ' + name + '...', end='\t')
 
     model.to(device)
 
     strategy = tp.strategy.L1Strategy()
-    DG = tp.DependencyGraph().build_dependency(model, example_inputs=torch.randn(1, 3, im_size, im_size))
+    DG = tp.DependencyGraph().build_dependency(model, example_inputs=torch.randn(1, in_ch, im_size, im_size))
 
     def prune_conv(conv, amount=0.2):
         pruning_index = strategy(conv.weight, amount=amount)
@@ -76,3 +76,18 @@ def quantize_model(name='', model=None, dir_models='', suffix='_quant'):
     print('COMPLETE')
 
     return model
+
+
+def fold_to_grayscale(model=None):
+    """
+    Folds the RGB first convolution of a model into a single-channel one, in place.
+    A grayscale image fed as RGB repeats the same plane three times, so summing the kernel over its input channels
+    gives the exact same response on a 1-channel input.
+    """
+    for m in model.modules():
+        if isinstance(m, modules.Conv2d):
+            if m.in_channels == 3:
+                m.weight = torch.nn.Parameter(m.weight.data.sum(dim=1, keepdim=True))
+                m.in_channels = 1
+            break
+    return model
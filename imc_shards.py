@@ -0,0 +1,154 @@
+"""
+Sequential-read sharded archives for the COVIDx CT-1 splits.
+
+pack_shards() copies the encoded images of a split into a few hundred tar shards (no re-encoding), and writes an
+index.json listing every shard with its sample count. ShardDataset then streams whole shards front to back, so each
+DataLoader worker does large contiguous reads instead of one random seek per image. Shuffling happens at the shard
+level (once per epoch) and again inside a bounded buffer of decoded samples.
+"""
+import io
+import os
+import json
+import random
+import tarfile
+import argparse
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from imc_dataset import Manifest
+from imc_decode import get_decoder
+
+INDEX_FILE = 'index.json'
+
+
+# =============================================================
+# NOTE PACKING TOOL
+# =============================================================
+def pack_shards(manifest, shard_dir, samples_per_shard=400, seed=12):
+    """Writes every (path, label) of the manifest into tar shards of samples_per_shard images each."""
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Shuffle once up-front so every shard holds a mix of both classes.
+    order = list(range(len(manifest)))
+    random.Random(seed).shuffle(order)
+
+    shards = []
+    for start in range(0, len(order), samples_per_shard):
+        name = 'shard-{:05d}.tar'.format(len(shards))
+        count = 0
+        with tarfile.open(os.path.join(shard_dir, name), 'w') as tar:
+            for idx in order[start:start + samples_per_shard]:
+                path, label = manifest[idx]
+                key = '{:08d}'.format(idx)
+                tar.add(path, arcname=key + os.path.splitext(path)[1].lower())
+                _add_bytes(tar, key + '.cls', str(label).encode('utf-8'))
+                count += 1
+        shards.append({'file': name, 'count': count})
+        print('Packed:\t', name, '\t({:,} images)'.format(count))
+
+    index = {'num_samples': len(order), 'shards': shards}
+    with open(os.path.join(shard_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def shards_exist(shard_dir):
+    return os.path.exists(os.path.join(shard_dir, INDEX_FILE))
+
+
+# =============================================================
+# NOTE SHARD DATASET
+# =============================================================
+class ShardDataset(IterableDataset):
+    def __init__(self, shard_dir, transform=None, shuffle=True, buffer_size=1000, decoder='pil', decode_size=None,
+                 channels=3):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.decode = get_decoder(decoder)
+        self.decode_size = decode_size
+        self.mode = 'L' if channels == 1 else 'RGB'
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+
+        with open(os.path.join(shard_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.shards = [os.path.join(shard_dir, s['file']) for s in index['shards']]
+        self.num_samples = index['num_samples']
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers = 0, 1
+            epoch_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            # The DataLoader draws a new base seed every epoch; all workers share it (seed = base + id).
+            worker_id, num_workers = worker.id, worker.num_workers
+            epoch_seed = worker.seed - worker.id
+        rng = random.Random(epoch_seed)
+
+        shards = list(self.shards)
+        if self.shuffle:
+            rng.shuffle(shards)
+        shards = shards[worker_id::num_workers]
+
+        samples = self._iter_samples(shards)
+        if self.shuffle:
+            samples = self._shuffle_buffer(samples, random.Random(epoch_seed + worker_id))
+
+        for image, label in samples:
+            image = self.decode(image, size=self.decode_size, mode=self.mode)
+            if self.transform:
+                image = self.transform(image)
+
+            yield {'img': image,
+                   'label': label}
+
+    @staticmethod
+    def _iter_samples(shards):
+        """Streams (encoded image, label) pairs in archive order."""
+        for shard in shards:
+            image = None
+            with tarfile.open(shard, 'r|') as tar:
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name.endswith('.cls'):
+                        yield image, int(data)
+                    else:
+                        image = data
+
+    def _shuffle_buffer(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a CT data split into sequential-read tar shards.')
+    parser.add_argument('root_dir', help="Image folder, e.g. data/ct_ctx/2A_images")
+    parser.add_argument('non_covid_files', help="Split file of non-COVID images, e.g. nc_train.txt")
+    parser.add_argument('covid_files', help="Split file of COVID images, e.g. co_train.txt")
+    parser.add_argument('shard_dir', help="Output folder for the shards & index")
+    parser.add_argument('--per-shard', type=int, default=400)
+    args = parser.parse_args()
+
+    pack_shards(Manifest.from_split_files(args.root_dir, ['CTX_NC', 'CTX_CO'],
+                                          [args.non_covid_files, args.covid_files], is_ctx=True),
+                args.shard_dir, samples_per_shard=args.per_shard)
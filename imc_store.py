@@ -0,0 +1,140 @@
+"""
+Pre-decoded image store, shared by the PyTorch and Keras pipelines.
+
+Every image of a dataset is decoded once, resized to the target size and written into a single uint8 array on disk
+(images.npy, shape N x H x W x C) next to a label array (labels.npy). Both are opened as memory maps, so
+DataLoader workers only page in the samples they touch and all of them share the OS page cache.
+
+A store can hold several splits of one dataset. store.json records each split's [start, stop) range in the arrays,
+along with the image size, channels and class names, so both frameworks read the same store per image size:
+    - PyTorch:  CTDataset(store=store_dir, store_split='train')
+    - Keras:    keras_dataset.image_dataset_from_store(store_dir, split='train')
+This module is NumPy/PIL only, so it can be imported from either side.
+"""
+import os
+import json
+import numpy as np
+from PIL import Image
+
+from imc_decode import get_decoder
+
+IMAGES_FILE = 'images.npy'
+LABELS_FILE = 'labels.npy'
+META_FILE = 'store.json'
+
+
+# =============================================================
+# NOTE MATERIALIZE STEP
+# =============================================================
+def materialize(image_list, store_dir, im_size=256, decoder='pil', channels=3, class_names=None, print_freq=1000):
+    """Decodes every (path, label) entry of image_list into store_dir, as a single 'all' split."""
+    return materialize_splits({'all': image_list}, store_dir, im_size=im_size, decoder=decoder, channels=channels,
+                              class_names=class_names, print_freq=print_freq)
+
+
+def materialize_splits(splits, store_dir, im_size=256, decoder='pil', channels=3, class_names=None,
+                       print_freq=1000):
+    """
+    Decodes every split of {name: [(path, label), ...]} into one store. Returns the whole opened ImageStore.
+    im_size is either an int (square images) or a (height, width) tuple.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    decode = get_decoder(decoder)
+    height, width = (im_size, im_size) if isinstance(im_size, int) else tuple(im_size)
+    num_ims = sum(len(image_list) for image_list in splits.values())
+
+    # Every path must resolve before decoding starts, rather than failing part way into a long materialize.
+    for name, image_list in splits.items():
+        missing = [path for path, _ in image_list if not os.path.isfile(path)]
+        if missing:
+            raise FileNotFoundError('{:,} of {:,} images of split "{}" not found, e.g.: {}'.format(
+                len(missing), len(image_list), name, missing[0]))
+
+    images = np.lib.format.open_memmap(os.path.join(store_dir, IMAGES_FILE + '.tmp'), mode='w+',
+                                       dtype=np.uint8, shape=(num_ims, height, width, channels))
+    labels = np.zeros(num_ims, dtype=np.uint8)
+    ranges = {}
+
+    print('Materializing', '{:,}'.format(num_ims), 'images to:\t', store_dir)
+    i = 0
+    for name, image_list in splits.items():
+        start = i
+        for path, label in image_list:
+            image = decode(path, size=min(height, width), mode='L' if channels == 1 else 'RGB')
+            image = image.resize((width, height), Image.BILINEAR)
+            images[i] = np.asarray(image, dtype=np.uint8).reshape(height, width, channels)
+            labels[i] = label
+            if print_freq and i % print_freq == 0:
+                print('[{:>7}/{}]'.format(i, num_ims))
+            i += 1
+        ranges[name] = [start, i]
+
+    images.flush()
+    del images
+
+    # Only publish the store once it is complete, so an interrupted run is never mistaken for a finished one.
+    meta = {'height': height, 'width': width, 'channels': channels, 'class_names': list(class_names or []),
+            'splits': ranges}
+    np.save(os.path.join(store_dir, LABELS_FILE), labels)
+    with open(os.path.join(store_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(os.path.join(store_dir, IMAGES_FILE + '.tmp'), os.path.join(store_dir, IMAGES_FILE))
+    print('Materializing:\t\t COMPLETE')
+
+    return ImageStore(store_dir)
+
+
+def store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, IMAGES_FILE)) and \
+           os.path.exists(os.path.join(store_dir, LABELS_FILE))
+
+
+# =============================================================
+# NOTE STORE READER
+# =============================================================
+class ImageStore:
+    def __init__(self, store_dir, split=None):
+        self.store_dir = store_dir
+        self.split = split
+
+        # Copy-on-write maps hand out writable, zero-copy views while leaving the file itself untouched.
+        self.images = np.load(os.path.join(store_dir, IMAGES_FILE), mmap_mode='c')
+        self.labels = np.load(os.path.join(store_dir, LABELS_FILE), mmap_mode='r')
+
+        self.meta = {}
+        if os.path.exists(os.path.join(store_dir, META_FILE)):
+            with open(os.path.join(store_dir, META_FILE)) as f:
+                self.meta = json.load(f)
+
+        # A split is a contiguous range of the arrays, so slicing keeps it a zero-copy memory map.
+        if split is not None:
+            if split not in self.meta.get('splits', {}):
+                raise ValueError('Split "' + str(split) + '" not found in store: ' + store_dir)
+            start, stop = self.meta['splits'][split]
+            self.images = self.images[start:stop]
+            self.labels = self.labels[start:stop]
+
+    # Memory maps are re-opened in each DataLoader worker rather than pickled (and copied) into it.
+    def __getstate__(self):
+        return {'store_dir': self.store_dir, 'split': self.split}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'], split=state['split'])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return self.images[idx], int(self.labels[idx])
+
+    @property
+    def im_size(self):
+        return self.images.shape[1]
+
+    @property
+    def class_names(self):
+        return self.meta.get('class_names', [])
+
+    @property
+    def split_names(self):
+        return list(self.meta.get('splits', {}))
@@ -2,10 +2,15 @@
 import numpy as np
 from tensorflow_core.python.keras.layers import image_preprocessing
 import keras_dataset_utils
+from imc_store import ImageStore
 from tensorflow.python.data.ops import dataset_ops
+from tensorflow.python.framework import dtypes
 from tensorflow.python.keras.preprocessing import image as keras_image_ops
 from tensorflow.python.ops import image_ops
 from tensorflow.python.ops import io_ops
+from tensorflow.python.ops import array_ops
+from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import script_ops
 
 ALLOWLIST_FORMATS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png')
 
@@ -23,7 +28,29 @@ def image_dataset_from_directory(directory,
                                  subset=None,
                                  interpolation='bilinear',
                                  follow_links=False,
-                                 smart_resize=False):
+                                 smart_resize=False,
+                                 performance=False,
+                                 num_parallel_calls=None,
+                                 cache=False,
+                                 prefetch=None,
+                                 shuffle_buffer=None):
+  """Keras' `image_dataset_from_directory`, with an optional performance mode.
+  Performance knobs (all off by default, which keeps the original pipeline):
+    performance: Shorthand for `num_parallel_calls` & `prefetch` set to
+        AUTOTUNE. Shuffling then happens on file paths before decoding.
+    num_parallel_calls: Parallelism of the decode `map` (int or AUTOTUNE).
+        When set, file paths are shuffled (with a full buffer) before they are
+        decoded, instead of shuffling decoded images in a small buffer.
+    cache: True to cache decoded images in memory, or a filename to cache them
+        on disk. Decoded images are then shuffled after the cache.
+    prefetch: Number of batches to prefetch (int or AUTOTUNE).
+    shuffle_buffer: Shuffle buffer of decoded images. Default: batch_size * 8.
+  """
+  if performance:
+    if num_parallel_calls is None:
+      num_parallel_calls = dataset_ops.AUTOTUNE
+    if prefetch is None:
+      prefetch = dataset_ops.AUTOTUNE
 
   if labels not in ('inferred', None):
     if not isinstance(labels, (list, tuple)):
@@ -89,11 +116,15 @@ def image_dataset_from_directory(directory,
       label_mode=label_mode,
       num_classes=len(class_names),
       interpolation=interpolation,
-      smart_resize=smart_resize)
-  if shuffle:
-    # Shuffle locally at each iteration
-    dataset = dataset.shuffle(buffer_size=batch_size * 8, seed=seed)
+      smart_resize=smart_resize,
+      shuffle=shuffle,
+      seed=seed,
+      num_parallel_calls=num_parallel_calls,
+      cache=cache,
+      shuffle_buffer=shuffle_buffer or batch_size * 8)
   dataset = dataset.batch(batch_size)
+  if prefetch:
+    dataset = dataset.prefetch(prefetch)
   # Users may need to reference `class_names`.
   dataset.class_names = class_names
   # Include file paths for images as attribute.
@@ -101,6 +132,62 @@ def image_dataset_from_directory(directory,
   return dataset
 
 
+def image_dataset_from_paths(image_paths,
+                             labels,
+                             class_names,
+                             label_mode='int',
+                             num_channels=3,
+                             batch_size=32,
+                             image_size=(256, 256),
+                             shuffle=True,
+                             seed=None,
+                             interpolation='bilinear',
+                             smart_resize=False,
+                             num_parallel_calls=dataset_ops.AUTOTUNE,
+                             cache=False,
+                             prefetch=dataset_ops.AUTOTUNE,
+                             dtype='uint8'):
+  """Streams batches of images from an explicit list of files.
+  Used to split a directory at the file-path level (e.g. train/val/test) and
+  still decode lazily, so only the prefetched batches are ever held in memory.
+  Args:
+    image_paths: List of image file paths.
+    labels: Integer labels matching `image_paths`.
+    class_names: Names of the classes, in label order.
+    dtype: Image dtype. uint8 (the default) keeps batches & caches at a quarter
+        of the float32 size; the models cast & rescale in-graph (see
+        `keras_preprocess.Preprocess`). None keeps the float32 resize output.
+  Other arguments are as for `image_dataset_from_directory` in performance mode.
+  Returns:
+    A `tf.data.Dataset` of (images, labels) batches.
+  """
+  if not len(image_paths):
+    raise ValueError('No images found.')
+  if seed is None:
+    seed = np.random.randint(1e6)
+  dataset = paths_and_labels_to_dataset(
+      image_paths=list(image_paths),
+      image_size=image_size,
+      num_channels=num_channels,
+      labels=np.asarray(labels, dtype='int32'),
+      label_mode=label_mode,
+      num_classes=len(class_names),
+      interpolation=image_preprocessing.get_interpolation(interpolation),
+      smart_resize=smart_resize,
+      shuffle=shuffle,
+      seed=seed,
+      num_parallel_calls=num_parallel_calls,
+      cache=cache,
+      shuffle_buffer=batch_size * 8,
+      dtype=dtype)
+  dataset = dataset.batch(batch_size)
+  if prefetch:
+    dataset = dataset.prefetch(prefetch)
+  dataset.class_names = class_names
+  dataset.file_paths = list(image_paths)
+  return dataset
+
+
 def paths_and_labels_to_dataset(image_paths,
                                 image_size,
                                 num_channels,
@@ -108,22 +195,53 @@ def paths_and_labels_to_dataset(image_paths,
                                 label_mode,
                                 num_classes,
                                 interpolation,
-                                smart_resize=False):
-  """Constructs a dataset of images and labels."""
-  # TODO(fchollet): consider making num_parallel_calls settable
+                                smart_resize=False,
+                                shuffle=False,
+                                seed=None,
+                                num_parallel_calls=None,
+                                cache=False,
+                                shuffle_buffer=256,
+                                dtype=None):
+  """Constructs a dataset of images and labels.
+  Without `num_parallel_calls` or `cache`, images are decoded one at a time and
+  then shuffled within `shuffle_buffer` (the original Keras pipeline).
+  With `num_parallel_calls`, the (path, label) pairs are shuffled as a whole
+  before decoding, which costs a few bytes per file instead of a decoded image
+  per buffer slot, and decoding runs in parallel.
+  With `cache`, decoded images are cached (in memory, or in the file named by
+  `cache`) and shuffled after the cache, so every epoch still gets a new order.
+  """
   path_ds = dataset_ops.Dataset.from_tensor_slices(image_paths)
-  args = (image_size, num_channels, interpolation, smart_resize)
-  img_ds = path_ds.map(
-      lambda x: load_image(x, *args))
   if label_mode:
     label_ds = keras_dataset_utils.labels_to_dataset(labels, label_mode, num_classes)
-    img_ds = dataset_ops.Dataset.zip((img_ds, label_ds))
+    path_ds = dataset_ops.Dataset.zip((path_ds, label_ds))
+
+  shuffle_files = shuffle and num_parallel_calls is not None and not cache
+  if shuffle_files:
+    path_ds = path_ds.shuffle(buffer_size=len(image_paths), seed=seed)
+
+  args = (image_size, num_channels, interpolation, smart_resize, dtype)
+  if label_mode:
+    img_ds = path_ds.map(
+        lambda x, y: (load_image(x, *args), y), num_parallel_calls=num_parallel_calls)
+  else:
+    img_ds = path_ds.map(
+        lambda x: load_image(x, *args), num_parallel_calls=num_parallel_calls)
+
+  if cache:
+    img_ds = img_ds.cache(cache if isinstance(cache, str) else '')
+  if shuffle and not shuffle_files:
+    # Shuffle locally at each iteration
+    img_ds = img_ds.shuffle(buffer_size=shuffle_buffer, seed=seed)
   return img_ds
 
 
 def load_image(path, image_size, num_channels, interpolation,
-               smart_resize=False):
-  """Load an image from a path and resize it."""
+               smart_resize=False, dtype=None):
+  """Load an image from a path and resize it.
+  Resizing yields float32; with `dtype='uint8'` the result is rounded back to
+  the decoded pixel range.
+  """
   img = io_ops.read_file(path)
   img = image_ops.decode_image(
       img, channels=num_channels, expand_animations=False)
@@ -132,5 +250,78 @@ def load_image(path, image_size, num_channels, interpolation,
                                        interpolation=interpolation)
   else:
     img = image_ops.resize_images_v2(img, image_size, method=interpolation)
+  if dtype is not None and dtypes.as_dtype(dtype) == dtypes.uint8:
+    img = math_ops.saturate_cast(math_ops.round(img), dtypes.uint8)
   img.set_shape((image_size[0], image_size[1], num_channels))
   return img
+
+
+def image_dataset_from_store(store_dir,
+                             split=None,
+                             label_mode='int',
+                             batch_size=32,
+                             shuffle=True,
+                             seed=None,
+                             indices=None,
+                             prefetch=None):
+  """Reads a split of a pre-decoded image store (see imc_store.py) as batches.
+  The store is shared with the PyTorch pipeline, so images are decoded & resized
+  once per image size for both frameworks.
+  Args:
+    store_dir: Directory written by `imc_store.materialize_splits`.
+    split: Name of the split to read (e.g. "train"), or None for all images.
+    label_mode: One of "int", "categorical", "binary" or None (images only).
+    batch_size: Size of the batches of data.
+    shuffle: Whether to shuffle the images (reshuffled every epoch).
+    seed: Optional random seed for shuffling.
+    indices: Optional subset of the split to read (e.g. from a train/test
+        split of the store's indices).
+    prefetch: Number of batches to prefetch (int or AUTOTUNE).
+  Returns:
+    A `tf.data.Dataset` of (uint8 images, labels) batches. Images keep the
+    stored (height, width, channels) shape.
+  """
+  if label_mode not in {'int', 'categorical', 'binary', None}:
+    raise ValueError(
+        '`label_mode` argument must be one of "int", "categorical", "binary", '
+        'or None. Received: %s' % (label_mode,))
+  store = ImageStore(store_dir, split=split)
+  if not len(store):
+    raise ValueError('No images found.')
+  class_names = store.class_names
+  num_classes = max(len(class_names), int(store.labels.max()) + 1)
+  image_shape = tuple(store.images.shape[1:])
+  if seed is None:
+    seed = np.random.randint(1e6)
+
+  def load_batch(indices):
+    # Sorted indices turn each batch into mostly-sequential reads of the map.
+    indices = np.sort(indices)
+    return store.images[indices], store.labels[indices].astype('int32')
+
+  def read_batch(indices):
+    images, labels = script_ops.numpy_function(
+        load_batch, [indices], [dtypes.uint8, dtypes.int32])
+    images.set_shape((None,) + image_shape)
+    labels.set_shape((None,))
+    if label_mode is None:
+      return images
+    if label_mode == 'binary':
+      labels = array_ops.expand_dims(math_ops.cast(labels, 'float32'), axis=-1)
+    elif label_mode == 'categorical':
+      labels = array_ops.one_hot(labels, num_classes)
+    return images, labels
+
+  if indices is None:
+    indices = np.arange(len(store))
+  print('Found %d stored images belonging to %d classes.' %
+        (len(indices), num_classes))
+  index_ds = dataset_ops.Dataset.from_tensor_slices(np.asarray(indices, dtype='int64'))
+  if shuffle:
+    index_ds = index_ds.shuffle(buffer_size=len(indices), seed=seed)
+  dataset = index_ds.batch(batch_size).map(read_batch)
+  if prefetch:
+    dataset = dataset.prefetch(prefetch)
+  # Users may need to reference `class_names`.
+  dataset.class_names = class_names
+  return dataset
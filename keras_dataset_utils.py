@@ -15,7 +15,9 @@
 """Keras image dataset loading utilities."""
 # pylint: disable=g-classes-have-attributes
 
+import json
 import multiprocessing
+import multiprocessing.pool
 import os
 
 import numpy as np
@@ -24,6 +26,10 @@ from tensorflow.python.data.ops import dataset_ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import math_ops
 
+# Persistent index of every scanned directory, kept at the top of the indexed directory.
+INDEX_CACHE_FILE = '.keras_index_cache.json'
+INDEX_CACHE_VERSION = 1
+
 
 def index_directory(directory,
                     labels,
@@ -31,7 +37,8 @@ def index_directory(directory,
                     class_names=None,
                     shuffle=True,
                     seed=None,
-                    follow_links=False):
+                    follow_links=False,
+                    cache=True):
   """Make list of all files in the subdirs of `directory`, with their labels.
   Args:
     directory: The target directory (string).
@@ -51,6 +58,8 @@ def index_directory(directory,
         If set to False, sorts the data in alphanumeric order.
     seed: Optional random seed for shuffling.
     follow_links: Whether to visits subdirectories pointed to by symlinks.
+    cache: Whether to keep a persistent index in `directory` (see
+        `scan_directories`), so repeat runs only re-list changed directories.
   Returns:
     tuple (file_paths, labels, class_names).
       file_paths: list of file paths (strings).
@@ -79,17 +88,15 @@ def index_directory(directory,
 
   # Build an index of the files
   # in the different class subfolders.
-  pool = multiprocessing.pool.ThreadPool()
-  results = []
+  dirpaths = [os.path.join(directory, subdir) for subdir in subdirs]
+  cache_path = os.path.join(directory, INDEX_CACHE_FILE) if cache else None
+  listing = scan_directories(dirpaths, formats, follow_links, cache_path)
   filenames = []
 
-  for dirpath in (os.path.join(directory, subdir) for subdir in subdirs):
-    results.append(
-        pool.apply_async(index_subdirectory,
-                         (dirpath, class_indices, follow_links, formats)))
   labels_list = []
-  for res in results:
-    partial_filenames, partial_labels = res.get()
+  for dirpath in dirpaths:
+    partial_filenames, partial_labels = index_subdirectory(
+        dirpath, class_indices, follow_links, formats, listing=listing)
     labels_list.append(partial_labels)
     filenames += partial_filenames
   if labels not in ('inferred', None):
@@ -110,8 +117,6 @@ def index_directory(directory,
   else:
     print('Found %d files belonging to %d classes.' %
           (len(filenames), len(class_names)))
-  pool.close()
-  pool.join()
   file_paths = [os.path.join(directory, fname) for fname in filenames]
 
   if shuffle:
@@ -133,7 +138,106 @@ def iter_valid_files(directory, follow_links, formats):
         yield root, fname
 
 
-def index_subdirectory(directory, class_indices, follow_links, formats):
+def iter_listed_files(directory, listing):
+  """Same order as `iter_valid_files`, read from a `scan_directories` listing."""
+  prefix = os.path.join(directory, '')
+  roots = [root for root in listing
+           if root == directory or root.startswith(prefix)]
+  for root in sorted(roots):
+    for fname in listing[root]:
+      yield root, fname
+
+
+def scan_directories(roots, formats, follow_links, cache_path=None):
+  """Lists the valid files of every directory under `roots`, in parallel.
+  Every directory found is its own task on a thread pool, so the scan spreads
+  over nested directories instead of one thread per class subfolder. Listing a
+  single directory is one sequential `os.scandir` pass (`DirEntry` types need
+  no extra `stat` calls), which is as fine-grained as a directory read gets.
+  With `cache_path`, the listing of each directory is stored along with its
+  modification time. A directory's mtime changes whenever a file is added,
+  removed or renamed in it, so on later runs only changed directories are
+  re-listed and everything else costs one `stat`.
+  Args:
+    roots: Directories to scan recursively.
+    formats: Allowlist of file extensions to index (e.g. ".jpg", ".txt").
+    follow_links: Whether to descend into subdirectories pointed to by symlinks.
+    cache_path: Optional path of the persistent index cache file.
+  Returns:
+    Dict mapping each directory path (as `os.walk` would spell it) to the
+    sorted list of valid file names directly inside it.
+  """
+  key = {'version': INDEX_CACHE_VERSION, 'formats': sorted(formats),
+         'follow_links': bool(follow_links)}
+  cached = {}
+  if cache_path and os.path.exists(cache_path):
+    try:
+      with open(cache_path) as f:
+        data = json.load(f)
+      if data.get('key') == key:
+        cached = data['dirs']
+    except (OSError, ValueError, KeyError):
+      cached = {}
+
+  base = os.path.dirname(cache_path) if cache_path else ''
+  pool = multiprocessing.pool.ThreadPool()
+  pending = []
+  listing = {}
+  entries = {}
+  changed = False
+
+  def submit(dirpath):
+    rel = os.path.relpath(dirpath, base) if base else dirpath
+    pending.append(pool.apply_async(
+        scan_one_directory,
+        (dirpath, rel, formats, follow_links, cached.get(rel))))
+
+  for root in roots:
+    submit(root)
+  while pending:
+    dirpath, rel, entry, rescanned = pending.pop().get()
+    listing[dirpath] = entry[1]
+    entries[rel] = entry
+    changed = changed or rescanned
+    for subdir in entry[2]:
+      submit(os.path.join(dirpath, subdir))
+  pool.close()
+  pool.join()
+
+  # Directories that disappeared are dropped by only writing what was visited.
+  if cache_path and (changed or set(entries) != set(cached)):
+    try:
+      with open(cache_path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'dirs': entries}, f)
+      os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+      pass  # A read-only dataset simply goes without a cache.
+  return listing
+
+
+def scan_one_directory(dirpath, rel, formats, follow_links, cached_entry=None):
+  """Lists one directory, or re-uses its cached listing if it is unchanged.
+  Returns:
+    tuple `(dirpath, rel, [mtime_ns, files, subdirs], rescanned)`.
+  """
+  mtime = os.stat(dirpath).st_mtime_ns
+  if cached_entry is not None and cached_entry[0] == mtime:
+    return dirpath, rel, cached_entry, False
+
+  files, subdirs = [], []
+  for entry in os.scandir(dirpath):
+    # Matches os.walk: symlinked directories are listed as directories but
+    # only descended into when following links.
+    if entry.is_dir():
+      if follow_links or not entry.is_symlink():
+        subdirs.append(entry.name)
+    elif entry.name.lower().endswith(formats):
+      files.append(entry.name)
+  return dirpath, rel, [mtime, sorted(files), sorted(subdirs)], True
+
+
+def index_subdirectory(directory, class_indices, follow_links, formats,
+                       listing=None):
   """Recursively walks directory and list image paths and their class index.
   Args:
     directory: string, target directory.
@@ -141,13 +245,17 @@ def index_subdirectory(directory, class_indices, follow_links, formats):
     follow_links: boolean, whether to recursively follow subdirectories
       (if False, we only list top-level images in `directory`).
     formats: Allowlist of file extensions to index (e.g. ".jpg", ".txt").
+    listing: Optional `scan_directories` result to read instead of walking.
   Returns:
     tuple `(filenames, labels)`. `filenames` is a list of relative file
       paths, and `labels` is a list of integer labels corresponding to these
       files.
   """
   dirname = os.path.basename(directory)
-  valid_files = iter_valid_files(directory, follow_links, formats)
+  if listing is None:
+    valid_files = iter_valid_files(directory, follow_links, formats)
+  else:
+    valid_files = iter_listed_files(directory, listing)
   labels = []
   filenames = []
   for root, fname in valid_files:
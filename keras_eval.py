@@ -1,9 +1,10 @@
 
 import numpy as np
-import tensorflow as tf
+from keras_tflite import TFLiteEngine, to_classes, measure_latency
 
 
 def eval_imc(name='', suffix='', eval_file='', divider='\n', model=None, x=None, y=None):
+    # NOTE: x may also be a tf.data.Dataset of (images, labels) batches, with y left as None.
     print("Evaluating:\t", name + suffix + "...", end='\t')
 
     _, accuracy = model.evaluate(x, y, verbose=0)
@@ -16,38 +17,50 @@ def eval_imc(name='', suffix='', eval_file='', divider='\n', model=None, x=None,
     print("COMPLETE")
 
 
-def eval_imc_tfl(name='', suffix='', eval_file='', divider='', model=None, test_images=None, test_labels=None):
+def eval_imc_tfl(name='', suffix='', eval_file='', divider='', model=None, test_images=None, test_labels=None,
+                 batch_size=32, workers=0):
+    # NOTE: Images run batch_size at a time through a multi-threaded interpreter (see keras_tflite). workers > 0 spreads
+    #       the batches over that many interpreter processes, which needs a script with a __main__ guard.
+    #       The model's size & single-image latency are reported with its accuracy, which is returned.
     print("Evaluating:\t", name + suffix + "...", end="\t")
 
-    interpreter = tf.lite.Interpreter(model_content=model)
-    interpreter.allocate_tensors()
-
-    input_index = interpreter.get_input_details()[0]["index"]
-    output_index = interpreter.get_output_details()[0]["index"]
-
-    # Run predictions on every image in the test dataset.
-    prediction_digits = []
-    for img in test_images:
-        # Pre-processing: add batch dimension and convert to float32 to match with the model's input data format.
-        img = np.expand_dims(img, axis=0).astype(np.float32)
-        interpreter.set_tensor(input_index, img)
-
-        # Run inference.
-        interpreter.invoke()
-
-        # Post-processing: remove batch dimension and find the digit with highest probability.
-        output = interpreter.tensor(output_index)
-        digit = np.argmax(output()[0])
-        prediction_digits.append(digit)
-
-    # Compare prediction results with ground truth labels to calculate accuracy.
-    prediction_digits = np.array(prediction_digits)
-    accuracy = (prediction_digits == test_labels).mean()
-
-    text = ['\n' + name + suffix + " TFL Accuracy:\t " + "%.1f" % (accuracy * 100) + "%", divider]
+    # Test images come either as arrays with their labels, or as a tf.data stream of (images, labels) batches.
+    if test_labels is None:
+        batches = ((images.numpy(), labels.numpy()) for images, labels in test_images)
+    else:
+        shard = 4 * batch_size
+        batches = [(test_images[start:start + shard], test_labels[start:start + shard])
+                   for start in range(0, len(test_images), shard)]
+
+    # Labels stay here, in the order their images are handed to the engine.
+    labels_seen = []
+
+    sample = []
+
+    def images_of(batches):
+        for images, labels in batches:
+            labels_seen.append(np.reshape(labels, -1))
+            if not sample:
+                sample.append(images[:8])
+            yield images
+
+    # Run predictions on every image in the test dataset. A single (sigmoid) output is thresholded, not argmax'ed.
+    correct, total = 0, 0
+    with TFLiteEngine(model, batch_size=batch_size, workers=workers, postprocess=to_classes) as engine:
+        for i, prediction_digits in enumerate(engine.map(images_of(batches))):
+            # Compare prediction results with ground truth labels to calculate accuracy.
+            correct += (prediction_digits == labels_seen[i]).sum()
+            total += len(prediction_digits)
+    accuracy = correct / max(total, 1)
+    latency = measure_latency(model, sample[0]) if sample else 0.0
+
+    text = ['\n' + name + suffix + " TFL Accuracy:\t " + "%.1f" % (accuracy * 100) + "%",
+            name + suffix + " TFL Size:\t\t " + "{:,.1f}".format(len(model) / 1024.) + " KB",
+            name + suffix + " TFL Latency:\t " + "{:.2f}".format(latency) + " ms / image", divider]
 
     with open(eval_file, 'a') as f:
         f.write('\n'.join(text))
     f.close()
 
     print("COMPLETE")
+    return accuracy
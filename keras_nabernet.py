@@ -1,18 +1,20 @@
 
 from tensorflow.keras.models import Sequential, Model
 from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, Dense, Flatten
+from keras_preprocess import Preprocess
 
 # ================================================================
-def nabernet(n_classes=2, im_size=(224, 224), n_channels=3):
+def nabernet(n_classes=2, im_size=(224, 224), n_channels=3, input_dtype='uint8', scale=1. / 255):
     # Model Parameters
     cdims = [32, 64, 64, 64, 64]
     fdims = [64, 32, 1 if n_classes <= 2 else n_classes]
     # fdims = [100, 64, n_classes]
 
-    inputs = Input(shape=im_size + (n_channels, ))
-    x = None
+    # NOTE: Images come in as raw uint8, the cast & rescale are the first graph ops (and carry over to TFLite).
+    inputs = Input(shape=im_size + (n_channels, ), dtype=input_dtype)
+    x = Preprocess(scale=scale)(inputs)
     for i, dim in enumerate(cdims):
-        x = Conv2D(dim, 3, activation='relu')(inputs) if i == 0 else Conv2D(dim, 3, activation='relu')(x)
+        x = Conv2D(dim, 3, activation='relu')(x)
         if i % 2 != 0:
             x = MaxPooling2D(2, 2)(x)
 
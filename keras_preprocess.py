@@ -0,0 +1,47 @@
+"""
+In-graph input preprocessing for the Keras models.
+
+Preprocess is the first layer of nabernet() and multi_unet_model(), so images can stay uint8 (or the raw TIFF dtype)
+all the way from the data pipeline into the model, and the TFLite exports take that dtype directly:
+    - cast to float32
+    - x * scale + offset            (e.g. scale=1/255 for uint8 images)
+    - optional L2 normalize         (l2_axis=1 matches tensorflow.keras.utils.normalize(x, axis=1))
+
+The layer has no weights. It is a PrunableLayer so prune_low_magnitude() can wrap the whole model, and it must be
+passed to load_model() via CUSTOM_OBJECTS.
+"""
+import tensorflow as tf
+from tensorflow.keras.layers import Layer
+import tensorflow_model_optimization as tfmot
+
+
+class Preprocess(Layer, tfmot.sparsity.keras.PrunableLayer):
+    def __init__(self, scale=1.0, offset=0.0, l2_axis=None, **kwargs):
+        super(Preprocess, self).__init__(**kwargs)
+        self.scale = scale
+        self.offset = offset
+        self.l2_axis = l2_axis
+
+    def call(self, inputs):
+        x = tf.cast(inputs, tf.float32)
+        if self.scale != 1.0 or self.offset != 0.0:
+            x = x * self.scale + self.offset
+        if self.l2_axis is not None:
+            # Same as keras' normalize(): all-zero lines are left as they are instead of dividing by zero.
+            norm = tf.sqrt(tf.reduce_sum(tf.square(x), axis=self.l2_axis, keepdims=True))
+            x = x / tf.where(tf.equal(norm, 0.0), tf.ones_like(norm), norm)
+        return x
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_prunable_weights(self):
+        return []
+
+    def get_config(self):
+        config = super(Preprocess, self).get_config()
+        config.update({'scale': self.scale, 'offset': self.offset, 'l2_axis': self.l2_axis})
+        return config
+
+
+CUSTOM_OBJECTS = {'Preprocess': Preprocess}
@@ -17,7 +17,11 @@ logging.getLogger('tensorflow').setLevel(logging.FATAL)
 
 # Tensorflow imports
 from tensorflow.python.keras import backend as K
-from keras_dataset import image_dataset_from_directory
+from keras_dataset import image_dataset_from_paths
+from keras_dataset import image_dataset_from_store
+from keras_dataset import ALLOWLIST_FORMATS
+from keras_dataset_utils import index_directory
+from imc_store import ImageStore, materialize_splits, store_exists
 import tensorflow as tf
 from tensorflow import lite
 import tensorflow_model_optimization as tfmot
@@ -28,9 +32,11 @@ from tensorflow.keras.utils import to_categorical
 
 # Models
 from keras_nabernet import nabernet
+from keras_preprocess import CUSTOM_OBJECTS
 from imc_resnet18 import build_ResNet
 from keras_eval import eval_imc
 from keras_eval import eval_imc_tfl
+from keras_tflite import convert_tflite
 
 # Metrics
 import sklearn.metrics as metrics
@@ -66,6 +72,10 @@ LOSS = 'binary_crossentropy'
 VERBOSITY = 2
 suffix = ""
 
+# SELECT: A pre-decoded image store shared with imc_main (imc_store.py), or None to decode from dir_data.
+# STORE_DIR = "C:\\Users\\elite\\PycharmProjects\\Pytorch\\data\\store\\UCSD_AI4H_300\\"
+STORE_DIR = None
+
 # Automatic dataset parameter assignment
 if "ucsd" in SET_NAME.lower():
     CLASSES = ["UCSD_CO", "UCSD_NC"]
@@ -99,24 +109,41 @@ MODEL = nabernet(n_classes=N_CLASSES, im_size=IM_SIZE)
 # MODEL = tf.keras.applications.resnet.ResNet50(include_top=False, weights=None, input_shape=IM_SIZE + (3,), classes=2)
 
 # ===================================================
-# STEP: Load Images & Labels into Dataset
+# STEP: Split Images & Labels into Streaming Datasets
 # ===================================================
-dataset = image_dataset_from_directory(
-    dir_data,
-    # label_mode='categorical',
-    seed=1337,
-    image_size=IM_SIZE,
-    batch_size=BATCH_SIZE,
-)
-
-x = np.concatenate([x for x, _ in dataset], axis=0)
-y = np.concatenate([y for _, y in dataset], axis=0)
-x = np.array(x).astype('uint8')
-y = np.array(y).astype('uint8')
-NUM_IMGS = len(x)
-
-x_train, x_temp, y_train, y_temp = train_test_split(x, y, test_size=0.3, shuffle=False)
-x_val, x_test, y_val, y_test = train_test_split(x_temp, y_temp, test_size=0.5, shuffle=False)
+# NOTE: Splits are made on file paths (or store indices), stratified & seeded. Images are only decoded as batches
+#       stream through, so memory is bounded by the prefetch depth rather than the dataset size.
+SEED = 1337
+if STORE_DIR:
+    if not store_exists(STORE_DIR):
+        paths, labels, class_names = index_directory(dir_data, 'inferred', formats=ALLOWLIST_FORMATS, shuffle=False)
+        materialize_splits({'all': list(zip(paths, labels))}, STORE_DIR, im_size=IM_SIZE, class_names=class_names)
+    store = ImageStore(STORE_DIR)
+    all_labels = np.asarray(store.labels)
+    all_items = np.arange(len(all_labels))
+    class_names = store.class_names
+else:
+    all_items, all_labels, class_names = index_directory(dir_data, 'inferred', formats=ALLOWLIST_FORMATS,
+                                                         shuffle=False)
+NUM_IMGS = len(all_items)
+
+items_train, items_temp, y_train, y_temp = train_test_split(all_items, all_labels, test_size=0.3,
+                                                            stratify=all_labels, random_state=SEED)
+items_val, items_test, y_val, y_test = train_test_split(items_temp, y_temp, test_size=0.5,
+                                                        stratify=y_temp, random_state=SEED)
+
+
+def make_dataset(items, labels, shuffle=False):
+    if STORE_DIR:
+        return image_dataset_from_store(STORE_DIR, indices=items, shuffle=shuffle, seed=SEED, batch_size=BATCH_SIZE,
+                                        prefetch=tf.data.experimental.AUTOTUNE)
+    return image_dataset_from_paths(items, labels, class_names, shuffle=shuffle, seed=SEED, batch_size=BATCH_SIZE,
+                                    image_size=IM_SIZE)
+
+
+train_ds = make_dataset(items_train, y_train, shuffle=True)
+val_ds = make_dataset(items_val, y_val)
+test_ds = make_dataset(items_test, y_test)
 
 # ===================================================
 # STEP: Compile, Fit, and Save Model
@@ -143,7 +170,7 @@ file = dir_models + MODEL_NAME + ".hdf5"
 
 # NOTE: Comment while evaluating, uncomment to train.
 MODEL.compile(optimizer=OPTIMIZER, loss=LOSS, metrics=['accuracy'])
-MODEL.fit(x=x_train, y=y_train, verbose=VERBOSITY, epochs=EPOCHS, validation_data=(x_val, y_val), shuffle=True)
+MODEL.fit(train_ds, verbose=VERBOSITY, epochs=EPOCHS, validation_data=val_ds)
 MODEL.save(file)
 print("\nSaved Model to:\t\t", file)
 
@@ -152,7 +179,7 @@ print("\nSaved Model to:\t\t", file)
 # ===================================================
 MODEL.load_weights(file)
 MODEL.compile(optimizer=OPTIMIZER, loss=LOSS, metrics=['accuracy'])
-eval_imc(name=MODEL_NAME, suffix=' Initial', eval_file=eval_file, divider=divider, model=MODEL, x=x_test, y=y_test)
+eval_imc(name=MODEL_NAME, suffix=' Initial', eval_file=eval_file, divider=divider, model=MODEL, x=test_ds)
 
 # =============================================================
 # STEP: Begin Pruning UNet
@@ -173,7 +200,7 @@ prune_low_magnitude = tfmot.sparsity.keras.prune_low_magnitude
 prune_epochs = 2
 validation_split = 0.1      # 10% of training set will be used for validation set.
 
-num_images = len(x_train)
+num_images = len(items_train)
 end_step = np.ceil(num_images / BATCH_SIZE).astype(np.int32) * prune_epochs
 
 # Define model for pruning.
@@ -200,9 +227,9 @@ f.close()
 print('Saved:\t\t Pruned Keras Model')
 
 # EVAL: Re-Loaded Pruned Model (hdf5)
-pruned_model = tf.keras.models.load_model(dir_models + MODEL_NAME + "_pruned.hdf5")
+pruned_model = tf.keras.models.load_model(dir_models + MODEL_NAME + "_pruned.hdf5", custom_objects=CUSTOM_OBJECTS)
 pruned_model.compile(optimizer=OPTIMIZER, loss=LOSS, metrics=['accuracy'])
-eval_imc(MODEL_NAME, suffix=" Pruned", eval_file=eval_file, divider=divider, model=pruned_model, x=x_test, y=y_test)
+eval_imc(MODEL_NAME, suffix=" Pruned", eval_file=eval_file, divider=divider, model=pruned_model, x=test_ds)
 
 # =============================================================
 # STEP: Convert Pruned Model to TFlite
@@ -220,26 +247,40 @@ print('Saved:\t\t Pruned TFLite Model')
 
 # EVAL: Pruned TFLite File
 eval_imc_tfl(name=MODEL_NAME, suffix=" Pruned", eval_file=eval_file, divider=divider,
-             model=pruned_tflite_model, test_images=x_test, test_labels=y_test)
+             model=pruned_tflite_model, test_images=test_ds)
 
 # =============================================================
-# STEP: Quantize Pruned File
+# STEP: Quantize Pruned File (Dynamic-Range, Float16 & Int8)
 # =============================================================
-print(divider)
-print("Quantizing Pruned Model...")
-converter = lite.TFLiteConverter.from_keras_model(pruned_model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-prune_quant_tfl_model = converter.convert()                # Weights are quantized now.
-
-filename = dir_models + MODEL_NAME + '_pq.tflite'
-with open(filename, 'wb') as f:
-    f.write(prune_quant_tfl_model)
-f.close()
-print("Saved:\t\t Pruned & Quantized TFLite Model")
-
-# EVAL: Pruned and Quantized File
-eval_imc_tfl(name=MODEL_NAME, suffix=" Quant.", eval_file=eval_file, divider=divider,
-             model=prune_quant_tfl_model, test_images=x_test, test_labels=y_test)
+# NOTE: The int8 variant is calibrated on QUANT_SAMPLES training images & takes/returns uint8.
+QUANT_SAMPLES = 200
+QUANT_SUFFIXES = {'dynamic': '_pq', 'float16': '_pq_f16', 'int8': '_pq_int8'}
+
+
+def representative_images():
+    count = 0
+    for images, _ in train_ds:
+        for image in images.numpy():
+            if count >= QUANT_SAMPLES:
+                return
+            count += 1
+            yield [image[np.newaxis].astype(np.float32)]
+
+
+for mode in ['dynamic', 'float16', 'int8']:
+    print(divider)
+    print("Quantizing Pruned Model (" + mode + ")...")
+    prune_quant_tfl_model = convert_tflite(pruned_model, mode=mode, representative=representative_images)
+
+    filename = dir_models + MODEL_NAME + QUANT_SUFFIXES[mode] + '.tflite'
+    with open(filename, 'wb') as f:
+        f.write(prune_quant_tfl_model)
+    f.close()
+    print("Saved:\t\t Pruned & Quantized TFLite Model (" + mode + ")")
+
+    # EVAL: Pruned and Quantized File
+    eval_imc_tfl(name=MODEL_NAME, suffix=" Quant. (" + mode + ")", eval_file=eval_file, divider=divider,
+                 model=prune_quant_tfl_model, test_images=test_ds)
 
 print(divider)
 print("All steps complete! Results saved to:", eval_file)
@@ -0,0 +1,239 @@
+"""
+Batched TFLite inference, shared by keras_eval, seg_eval & seg_infer.
+
+BatchedInterpreter resizes a model's input to batch_size once, so a whole batch runs per invoke() instead of one image
+per Python loop iteration (the last, short batch is zero-padded). Interpreters run on num_threads threads (default:
+every core) and, where the installed TensorFlow has it, with the XNNPACK delegate for float ops.
+
+TFLiteEngine runs batches either in-process, or spread over a pool of worker processes (workers > 0), each holding its
+own interpreter on cores / workers threads. Batches are handed out in order with only a few in flight per worker, so
+memory stays bounded by those batches whatever the size of the test set.
+    engine = TFLiteEngine(tflite_model, batch_size=32, workers=4, postprocess=to_classes)
+    for classes in engine.map(batches): ...
+NOTE: Worker processes are spawned, so they re-import the calling script: only use workers from scripts whose work is
+      under an 'if __name__ == "__main__":' guard (e.g. seg_run.py, not keras_run.py).
+
+convert_tflite() exports a Keras model in one of QUANT_MODES:
+    - none:     float32
+    - dynamic:  int8 weights, float activations (Optimize.DEFAULT, the usual _pq.tflite)
+    - float16:  float16 weights
+    - int8:     int8 weights & activations, calibrated on a representative dataset, with uint8, int8 (TF >= 2.3) or
+                float input & output
+A quantized input or output is (de)quantized on the host by BatchedInterpreter, from the dtype & quantization the
+converted model reports, so every variant takes & returns the same values as the Keras model. measure_latency() times
+single inputs for comparing them.
+"""
+import os
+import time
+import collections
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+from tensorflow import lite
+
+QUANT_MODES = ['none', 'dynamic', 'float16', 'int8']
+
+
+def make_interpreter(model_content, num_threads=None, xnnpack=True):
+    """
+    A tf.lite.Interpreter on num_threads threads (default: every core), with XNNPACK when available. On TensorFlow
+    versions whose Interpreter has no num_threads (before 2.3), the default interpreter is returned.
+    """
+    kwargs = {'model_content': model_content}
+    resolver = getattr(tf.lite.experimental, 'OpResolverType', None)
+    if resolver is not None:
+        # The builtin resolver applies the default (XNNPACK) delegate, the other one leaves it out.
+        kwargs['experimental_op_resolver_type'] = resolver.BUILTIN if xnnpack else \
+            resolver.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    try:
+        return tf.lite.Interpreter(num_threads=num_threads or os.cpu_count(), **kwargs)
+    except TypeError:
+        return tf.lite.Interpreter(**kwargs)
+
+
+def to_classes(outputs):
+    """Class ids of model outputs: argmax over the last axis, or a 0.5 threshold for a single sigmoid unit."""
+    if outputs.shape[-1] == 1:
+        return (outputs[..., 0] > 0.5).astype(np.uint8)
+    return np.argmax(outputs, axis=-1).astype(np.uint8)
+
+
+def measure_latency(model_content, images, runs=20, num_threads=None):
+    """Median milliseconds of one invoke() on a single input (of images, in turn), after a warm-up run."""
+    runner = BatchedInterpreter(model_content, batch_size=1, num_threads=num_threads)
+    runner.invoke(images[:1])
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        runner.invoke(images[i % len(images)][np.newaxis])
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+# =============================================================
+# NOTE CONVERSION
+# =============================================================
+def float_input(model):
+    """The model (same weights) with a float32 input, so the int8 converter can calibrate & quantize that input."""
+    if model.inputs[0].dtype == tf.float32:
+        return model
+    clone = tf.keras.models.clone_model(model, input_tensors=tf.keras.Input(model.input_shape[1:], dtype='float32'))
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+def convert_tflite(model, mode='none', representative=None, io_dtype='uint8'):
+    """
+    TFLite export of a Keras model in one of QUANT_MODES. representative (int8 only) is a callable returning an iterable
+    of [input batch] lists, e.g. a few hundred training images as float32 in the model's input range.
+    io_dtype (int8 only) is the input & output dtype: 'uint8', 'int8' or None (float, quantized in-graph).
+    NOTE: Converters before TF 2.3 ignore a uint8/int8 io_dtype & keep float input & output. The dtype the model
+          really has is read back (& reported when it differs), BatchedInterpreter always goes by the model's own.
+    """
+    if mode not in QUANT_MODES:
+        raise ValueError('Quantization mode must be one of ' + str(QUANT_MODES) + ', got ' + str(mode))
+    if mode == 'int8':
+        if representative is None:
+            raise ValueError('Full-integer (int8) quantization needs a representative dataset.')
+        model = float_input(model)
+
+    converter = lite.TFLiteConverter.from_keras_model(model)
+    if mode != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        converter.representative_dataset = representative
+        # Ops without an int8 kernel (e.g. the L2 normalize of Preprocess) stay float instead of failing the export.
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+        if io_dtype is not None:
+            converter.inference_input_type = tf.as_dtype(io_dtype)
+            converter.inference_output_type = tf.as_dtype(io_dtype)
+    tflite_model = converter.convert()
+
+    if mode == 'int8' and io_dtype is not None:
+        input_dtype = tf.lite.Interpreter(model_content=tflite_model).get_input_details()[0]['dtype']
+        if tf.as_dtype(input_dtype) != tf.as_dtype(io_dtype):
+            print("NOTE:\t\t\t int8 model has", tf.as_dtype(input_dtype).name, "input & output, not", io_dtype,
+                  "(TF", tf.__version__ + ")")
+    return tflite_model
+
+
+# =============================================================
+# NOTE BATCHED INTERPRETER
+# =============================================================
+class BatchedInterpreter:
+    def __init__(self, model_content, batch_size=32, num_threads=None, xnnpack=True, postprocess=None):
+        self.interpreter = make_interpreter(model_content, num_threads=num_threads, xnnpack=xnnpack)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.batch_size = batch_size
+        self.postprocess = postprocess
+        self.interpreter.resize_tensor_input(self.input_details['index'],
+                                             [batch_size] + list(self.input_details['shape'][1:]))
+        self.interpreter.allocate_tensors()
+
+    @property
+    def input_dtype(self):
+        return self.input_details['dtype']
+
+    def invoke(self, batch):
+        """Outputs of at most batch_size inputs, in one invoke()."""
+        count = len(batch)
+        if count < self.batch_size:
+            batch = np.concatenate([batch, np.zeros((self.batch_size - count,) + batch.shape[1:], dtype=batch.dtype)])
+        scale, zero_point = self.input_details['quantization']
+        if scale:
+            limits = np.iinfo(self.input_dtype)
+            batch = np.clip(np.round(batch.astype(np.float32) / scale + zero_point), limits.min, limits.max)
+        self.interpreter.set_tensor(self.input_details['index'], batch.astype(self.input_dtype))
+        self.interpreter.invoke()
+
+        outputs = self.interpreter.get_tensor(self.output_details['index'])[:count]
+        scale, zero_point = self.output_details['quantization']
+        if scale:
+            outputs = (outputs.astype(np.float32) - zero_point) * scale
+        return outputs
+
+    def predict(self, images):
+        """Outputs (or postprocess(outputs)) of any number of inputs, batch_size at a time."""
+        outputs = [self.invoke(images[start:start + self.batch_size])
+                   for start in range(0, len(images), self.batch_size)]
+        if self.postprocess is not None:
+            outputs = [self.postprocess(output) for output in outputs]
+        return np.concatenate(outputs)
+
+
+# =============================================================
+# NOTE INTERPRETER POOL
+# =============================================================
+_worker = None
+
+
+def _init_worker(model_content, batch_size, num_threads, xnnpack, postprocess):
+    global _worker
+    _worker = BatchedInterpreter(model_content, batch_size=batch_size, num_threads=num_threads, xnnpack=xnnpack,
+                                 postprocess=postprocess)
+
+
+def _predict_shard(images):
+    return _worker.predict(images)
+
+
+class TFLiteEngine:
+    def __init__(self, model_content, batch_size=32, workers=0, num_threads=None, xnnpack=True, postprocess=None,
+                 in_flight=2):
+        """
+        workers=0 runs in-process on num_threads threads (default: every core). workers > 0 (or None: one per core)
+        starts that many processes, each on num_threads (default: cores / workers) threads. postprocess (e.g.
+        to_classes) is applied next to the interpreter, so workers send back class ids rather than probabilities; it
+        must be a module-level function when using workers.
+        """
+        cores = os.cpu_count() or 1
+        self.workers = cores if workers is None else workers
+        self.batch_size = batch_size
+        self.in_flight = in_flight
+        self.pool = None
+        self.runner = None
+        if self.workers > 0:
+            threads = num_threads or max(1, cores // self.workers)
+            self.pool = multiprocessing.get_context('spawn').Pool(
+                self.workers, initializer=_init_worker,
+                initargs=(model_content, batch_size, threads, xnnpack, postprocess))
+        else:
+            self.runner = BatchedInterpreter(model_content, batch_size=batch_size, num_threads=num_threads,
+                                             xnnpack=xnnpack, postprocess=postprocess)
+
+    def map(self, shards):
+        """Outputs of each shard (an array of inputs) of an iterable, in order."""
+        if self.pool is None:
+            for shard in shards:
+                yield self.runner.predict(shard)
+            return
+
+        # At most in_flight shards per worker are queued, so an endless stream is never read ahead into memory.
+        pending = collections.deque()
+        for shard in shards:
+            pending.append(self.pool.apply_async(_predict_shard, (np.asarray(shard),)))
+            if len(pending) >= self.workers * self.in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def predict(self, images, shard_size=None):
+        """Outputs of an array of inputs, split into shard_size (default: 4 batches per shard) shards."""
+        shard_size = shard_size or 4 * self.batch_size
+        shards = (images[start:start + shard_size] for start in range(0, len(images), shard_size))
+        return np.concatenate(list(self.map(shards)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
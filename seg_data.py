@@ -0,0 +1,463 @@
+"""
+Streaming access to the MedSeg TIFF volumes.
+
+SliceIndex maps every slice of every volume in an image folder (and its mask folder) to a (volume, slice) pair, and
+opens each volume with tifffile.memmap. Volumes that cannot be memory-mapped (e.g. compressed ones) fall back to
+reading one page at a time. Either way a slice is only read when it is asked for, so nothing is loaded up-front.
+
+Masks are encoded onto 0..n_classes-1 through a 256-entry lookup table (LUT) over the int8 mask values. The sorted
+mask values behind it are scanned once and cached next to the masks (MASK_LUT_FILE), keyed by the mask files' sizes
+and modification times.
+
+With packed_masks=True the encoded masks are also written once into a bit-packed store next to the masks
+(PACKED_MASK_FILE): 2 bits per pixel for up to 4 classes, i.e. 4x smaller than int8 on disk & in the page cache. It is
+memory-mapped, and mask batches are unpacked with a vectorized shift & mask.
+
+class_histograms() counts the pixels of every class in every slice (HISTOGRAM_FILE, cached next to the masks), and
+ForegroundSampler uses it to cap the share of all-background slices per batch & oversample slices of rare classes.
+
+compute_rois() finds one lung bounding box per volume (thresholding & morphology, cached as ROI_FILE next to the
+images) and places a fixed-size ROI window over it, shared by the whole dataset & rounded up to a multiple of 16 for the
+U-Net. With crop=True, batches hold only that window; paste_batch() puts ROI predictions back into full-size masks.
+
+make_dataset() streams batches of slices & masks (sparse class ids, or one-hot) through tf.data, so training only
+holds a few batches in memory instead of the whole stack:
+    - dtype=None:               raw slices, for models that preprocess in-graph (seg_unet with L2_AXIS=1).
+    - dtype='float32'/'float16': each batch is L2 normalized along norm_axis (as keras' normalize(x, axis=1)).
+eval_batches() streams a test split the same way as NumPy batches, in order, with full-size masks for evaluation.
+"""
+import os
+import json
+import numpy as np
+import tifffile
+from scipy import ndimage
+import tensorflow as tf
+
+TIFF_FORMATS = ('.tif', '.tiff')
+MASK_LUT_FILE = '.mask_lut.json'
+PACKED_MASK_FILE = '.masks_packed.npy'
+PACKED_META_FILE = '.masks_packed.json'
+HISTOGRAM_FILE = '.mask_histograms.npz'
+ROI_FILE = '.lung_rois.json'
+
+
+# =============================================================
+# NOTE VOLUME READERS
+# =============================================================
+class LazyVolume:
+    """Page-by-page reader, for TIFFs whose data is not laid out contiguously enough to memory-map."""
+    def __init__(self, path):
+        self.tif = tifffile.TiffFile(path)
+        self.pages = self.tif.pages
+        first = self.pages[0]
+        self.shape = (len(self.pages),) + tuple(first.shape)
+        self.dtype = first.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return self.pages[idx].asarray()
+
+
+def open_volume(path):
+    """Returns a (slices, height, width) array-like over a TIFF volume, without reading its data."""
+    try:
+        volume = tifffile.memmap(path, mode='r')
+    except ValueError:
+        return LazyVolume(path)
+    return volume if volume.ndim > 2 else volume[np.newaxis]
+
+
+def list_tiffs(directory):
+    return sorted(f for f in os.listdir(directory) if f.lower().endswith(TIFF_FORMATS))
+
+
+def as_lut_index(mask):
+    """Masks are int8 (as seg_run always cast them), viewed as uint8 to index a 256-entry table."""
+    return np.asarray(mask).astype(np.int8, copy=False).view(np.uint8)
+
+
+def bits_for(n_classes):
+    """Smallest of 1, 2, 4 or 8 bits that holds every class id."""
+    for bits in (1, 2, 4):
+        if n_classes <= 1 << bits:
+            return bits
+    return 8
+
+
+def pack_bits(ids, bits):
+    """Packs class ids (..., H, W) into (..., ceil(H * W * bits / 8)) bytes, lowest bits first."""
+    per_byte = 8 // bits
+    flat = ids.reshape(ids.shape[:-2] + (-1,)).astype(np.uint8)
+    pad = -flat.shape[-1] % per_byte
+    if pad:
+        flat = np.concatenate([flat, np.zeros(flat.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+    flat = flat.reshape(flat.shape[:-1] + (-1, per_byte))
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    return np.bitwise_or.reduce(flat << shifts, axis=-1)
+
+
+def unpack_bits(packed, bits, shape):
+    """Inverse of pack_bits: (..., n_bytes) -> (..., H, W) uint8 class ids."""
+    shifts = np.arange(0, 8, bits, dtype=np.uint8)
+    ids = (packed[..., np.newaxis] >> shifts) & np.uint8((1 << bits) - 1)
+    ids = ids.reshape(packed.shape[:-1] + (-1,))[..., :shape[0] * shape[1]]
+    return ids.reshape(packed.shape[:-1] + tuple(shape))
+
+
+# =============================================================
+# NOTE LUNG ROI
+# =============================================================
+def lung_bbox(volume, threshold=None, stride=1):
+    """
+    (top, left, bottom, right) around the lungs of a whole volume: the dark regions enclosed by the (bright) body.
+    The threshold defaults to halfway between the 5th & 95th percentiles of the middle slice.
+    """
+    if threshold is None:
+        lo, hi = np.percentile(np.asarray(volume[len(volume) // 2]), (5, 95))
+        threshold = (lo + hi) / 2
+    union = None
+    for i in range(0, len(volume), stride):
+        img = np.asarray(volume[i])
+        body = ndimage.binary_opening(img > threshold, iterations=2)
+        lungs = ndimage.binary_fill_holes(body) & ~body
+        lungs = ndimage.binary_opening(lungs, iterations=3)
+        union = lungs if union is None else union | lungs
+
+    rows, cols = np.flatnonzero(union.any(axis=1)), np.flatnonzero(union.any(axis=0))
+    if not len(rows):
+        return 0, 0, union.shape[0], union.shape[1]
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+def crop_batch(x, origins, size):
+    """Cuts an (h, w) window at each sample's (top, left) origin out of a (N, H, W, ...) batch, in one gather."""
+    rows = np.asarray(origins)[:, 0, np.newaxis] + np.arange(size[0])
+    cols = np.asarray(origins)[:, 1, np.newaxis] + np.arange(size[1])
+    return x[np.arange(len(x))[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+
+
+def paste_batch(x, origins, shape, fill=0):
+    """Inverse of crop_batch: puts (N, h, w, ...) windows back into (N, H, W, ...) arrays filled with fill."""
+    rows = np.asarray(origins)[:, 0, np.newaxis] + np.arange(x.shape[1])
+    cols = np.asarray(origins)[:, 1, np.newaxis] + np.arange(x.shape[2])
+    out = np.full((len(x),) + tuple(shape) + x.shape[3:], fill, dtype=x.dtype)
+    out[np.arange(len(x))[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]] = x
+    return out
+
+
+# =============================================================
+# NOTE SLICE INDEX
+# =============================================================
+class SliceIndex:
+    def __init__(self, image_dir, mask_dir=None, packed_masks=False):
+        self.image_files = [os.path.join(image_dir, f) for f in list_tiffs(image_dir)]
+        self.mask_files = [os.path.join(mask_dir, f) for f in list_tiffs(mask_dir)] if mask_dir else []
+        if not self.image_files:
+            raise ValueError('No TIFF volumes found in: ' + image_dir)
+        if mask_dir and len(self.mask_files) != len(self.image_files):
+            raise ValueError('Found ' + str(len(self.image_files)) + ' image volumes but ' +
+                             str(len(self.mask_files)) + ' mask volumes.')
+
+        # Image & mask volumes are paired by sorted file name.
+        self.images = [open_volume(f) for f in self.image_files]
+        self.masks = [open_volume(f) for f in self.mask_files]
+        for image, mask, name in zip(self.images, self.masks, self.image_files):
+            if len(image) != len(mask):
+                raise ValueError('Slice count of ' + name + ' does not match its mask volume.')
+
+        counts = [len(v) for v in self.images]
+        self.volume_of = np.repeat(np.arange(len(counts)), counts)
+        self.slice_of = np.concatenate([np.arange(c) for c in counts])
+        self.image_dir = image_dir
+        self.mask_dir = mask_dir
+        self.roi_size = None
+        self.roi_origins = None
+        self._classes = None
+        self._lut = None
+        self.packed = None
+        if packed_masks and self.masks:
+            self.packed, self.bits = self.open_packed()
+
+    def __len__(self):
+        return len(self.volume_of)
+
+    @property
+    def shape(self):
+        """(height, width) of a slice."""
+        return tuple(self.images[0].shape[1:3])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.images[0].dtype)
+
+    def image(self, idx):
+        return np.asarray(self.images[self.volume_of[idx]][self.slice_of[idx]])
+
+    def mask(self, idx):
+        return np.asarray(self.masks[self.volume_of[idx]][self.slice_of[idx]])
+
+    @property
+    def classes(self):
+        """Sorted int8 mask values, as LabelEncoder would find them. Loaded from the LUT cache when it is current."""
+        if self._classes is None:
+            key = self._mask_key()
+            cache_file = os.path.join(self.mask_dir, MASK_LUT_FILE)
+            if os.path.exists(cache_file):
+                with open(cache_file) as f:
+                    cached = json.load(f)
+                if cached.get('files') == key:
+                    self._classes = np.array(cached['classes'], dtype=np.int8)
+            if self._classes is None:
+                self._classes = self._scan_classes()
+                try:
+                    with open(cache_file, 'w') as f:
+                        json.dump({'files': key, 'classes': self._classes.tolist()}, f, indent=1)
+                except OSError:
+                    pass
+        return self._classes
+
+    def _mask_key(self):
+        return {os.path.basename(f): [os.path.getsize(f), os.stat(f).st_mtime_ns] for f in self.mask_files}
+
+    def _scan_classes(self):
+        """One bincount per slice over the 256 possible int8 values, instead of sorting every pixel."""
+        counts = np.zeros(256, dtype=np.int64)
+        for mask in self.masks:
+            for i in range(len(mask)):
+                counts += np.bincount(as_lut_index(mask[i]).ravel(), minlength=256)
+        return np.sort(np.flatnonzero(counts).astype(np.uint8).view(np.int8))
+
+    @property
+    def lut(self):
+        if self._lut is None:
+            self._lut = np.zeros(256, dtype=np.uint8)
+            self._lut[self.classes.view(np.uint8)] = np.arange(len(self.classes), dtype=np.uint8)
+        return self._lut
+
+    def encode(self, mask):
+        """Maps raw mask values onto 0..n_classes-1 with a single table lookup."""
+        return self.lut[as_lut_index(mask)]
+
+    def open_packed(self):
+        """Memory-maps the bit-packed mask store, (re)writing it first if it is missing or out of date."""
+        packed_file = os.path.join(self.mask_dir, PACKED_MASK_FILE)
+        meta_file = os.path.join(self.mask_dir, PACKED_META_FILE)
+        key = self._mask_key()
+        meta = {}
+        if os.path.exists(meta_file) and os.path.exists(packed_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        if meta.get('files') != key:
+            meta = self.write_packed(packed_file, meta_file, key)
+        return np.load(packed_file, mmap_mode='r'), meta['bits']
+
+    def write_packed(self, packed_file, meta_file, key):
+        """Encodes & packs one slice at a time into a new store."""
+        bits = bits_for(len(self.classes))
+        height, width = self.shape
+        n_bytes = -(-height * width * bits // 8)
+        packed = np.lib.format.open_memmap(packed_file + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(self), n_bytes))
+        for i in range(len(self)):
+            packed[i] = pack_bits(self.encode(self.mask(i)), bits)
+        packed.flush()
+        del packed
+        os.replace(packed_file + '.tmp', packed_file)
+
+        meta = {'files': key, 'bits': bits, 'height': height, 'width': width}
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f, indent=1)
+        return meta
+
+    def compute_rois(self, margin=8, multiple=16):
+        """Sets roi_size (h, w) & one (top, left) ROI origin per volume. Cached next to the images."""
+        key = digest_key([[os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns]
+                          for f in self.image_files] + [margin, multiple])
+        cache_file = os.path.join(self.image_dir, ROI_FILE)
+        boxes = None
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get('key') == key:
+                boxes = np.array(cached['boxes'])
+        if boxes is None:
+            boxes = np.array([lung_bbox(volume) for volume in self.images])
+            try:
+                with open(cache_file, 'w') as f:
+                    json.dump({'key': key, 'boxes': boxes.tolist()}, f, indent=1)
+            except OSError:
+                pass
+
+        # One window size for every volume, so batches stack: the largest box plus margins, rounded up.
+        full = np.array(self.shape)
+        extent = (boxes[:, 2:] - boxes[:, :2]).max(axis=0) + 2 * margin
+        size = np.minimum(-(-extent // multiple) * multiple, full)
+        centre = (boxes[:, :2] + boxes[:, 2:]) // 2
+        self.roi_size = tuple(int(v) for v in size)
+        self.roi_origins = np.clip(centre - size // 2, 0, full - size)
+        return self.roi_size
+
+    def origins(self, indices):
+        return self.roi_origins[self.volume_of[np.asarray(indices)]]
+
+    @property
+    def input_shape(self):
+        """(height, width) of the model input: the ROI once computed, else the full slice."""
+        return self.roi_size or self.shape
+
+    def class_histograms(self, chunk=64):
+        """(N, n_classes) pixel counts per slice. Cached next to the masks, keyed like the LUT."""
+        key = digest_key(self._mask_key())
+        cache_file = os.path.join(self.mask_dir, HISTOGRAM_FILE)
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            if str(cached['key']) == key:
+                return cached['counts']
+
+        # One offset bincount per chunk of slices: row r's class c lands in bin r * n_classes + c.
+        n_classes = len(self.classes)
+        counts = np.zeros((len(self), n_classes), dtype=np.int64)
+        for start in range(0, len(self), chunk):
+            rows = np.arange(start, min(start + chunk, len(self)))
+            # Masks only: reading the image slices too would double the I/O (& decode every page of a LazyVolume).
+            if self.packed is not None:
+                masks = unpack_bits(self.packed[rows], self.bits, self.shape)
+            else:
+                masks = self.encode(np.stack([self.mask(i) for i in rows]))
+            bins = masks.reshape(len(rows), -1).astype(np.int64) + (np.arange(len(rows)) * n_classes)[:, np.newaxis]
+            counts[rows] = np.bincount(bins.ravel(), minlength=len(rows) * n_classes).reshape(len(rows), n_classes)
+        try:
+            np.savez(cache_file, key=key, counts=counts)
+        except OSError:
+            pass
+        return counts
+
+    def batch(self, indices, encode=True, crop=False):
+        """Stacks the slices (N, H, W, 1) and encoded masks (N, H, W, 1) of the given indices, or their ROIs."""
+        images = np.stack([self.image(i) for i in indices])[..., np.newaxis]
+        if crop:
+            images = crop_batch(images, self.origins(indices), self.roi_size)
+        if not self.masks:
+            return images, None
+        if encode and self.packed is not None:
+            masks = unpack_bits(self.packed[np.asarray(indices)], self.bits, self.shape)
+        else:
+            masks = np.stack([self.mask(i) for i in indices])
+            masks = self.encode(masks) if encode else masks
+        if crop:
+            masks = crop_batch(masks, self.origins(indices), self.roi_size)
+        return images, masks[..., np.newaxis]
+
+
+def digest_key(key):
+    return json.dumps(key, sort_keys=True)
+
+
+# =============================================================
+# NOTE FOREGROUND SAMPLER
+# =============================================================
+class ForegroundSampler:
+    """
+    Draws the batches of an epoch from per-slice class histograms:
+        - At most max_empty of each batch are background-only slices (fewer if they are rarer than that).
+        - Other slices are drawn with replacement, weighted by the rarest class they contain: a class seen in n slices
+          weighs (1 / n) ** class_power. 0 samples foreground slices uniformly, 1 balances classes by slice count.
+    """
+    def __init__(self, histograms, indices, batch_size=4, max_empty=0.25, class_power=0.5, background=0,
+                 epoch_size=None, seed=0):
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.max_empty = max_empty
+        self.epoch_size = epoch_size or len(self.indices)
+        self.seed = seed
+
+        present = histograms[self.indices] > 0
+        foreground = np.delete(present, background, axis=1)
+        is_empty = ~foreground.any(axis=1)
+        self.empty = self.indices[is_empty]
+        self.foreground = self.indices[~is_empty]
+        self.empty_share = is_empty.mean()
+
+        class_weights = 1.0 / np.maximum(foreground.sum(axis=0), 1) ** class_power
+        weights = (foreground[~is_empty] * class_weights).max(axis=1)
+        self.weights = weights / weights.sum() if len(weights) else weights
+
+    def __len__(self):
+        return -(-self.epoch_size // self.batch_size)
+
+    def batches(self, epoch=0):
+        rng = np.random.RandomState(self.seed + epoch)
+        for _ in range(len(self)):
+            if not len(self.foreground):
+                n_empty = self.batch_size
+            else:
+                n_empty = min(rng.binomial(self.batch_size, self.empty_share), int(self.max_empty * self.batch_size))
+            batch = rng.choice(self.empty, n_empty)
+            # No foreground draw for a background-only batch: choice() rejects an empty p.
+            if self.batch_size - n_empty > 0 and len(self.foreground):
+                batch = np.concatenate([batch, rng.choice(self.foreground, self.batch_size - n_empty, p=self.weights)])
+            rng.shuffle(batch)
+            yield batch
+
+
+# =============================================================
+# NOTE TF.DATA PIPELINE
+# =============================================================
+def normalize_batch(images, dtype='float32', axis=1):
+    """L2 normalize a batch along axis, as keras' normalize(). The norm is taken in float32 (float16 overflows)."""
+    x = images.astype(np.float32)
+    norm = np.sqrt(np.sum(x * x, axis=axis, keepdims=True))
+    norm[norm == 0] = 1
+    return (x / norm).astype(dtype)
+
+
+def eval_batches(index, indices, batch_size=16, dtype=None, norm_axis=1, crop=False):
+    """
+    (images, masks) NumPy batches of the given slice indices, in order. With crop=True the images are the ROIs while the
+    masks stay full-size, so ROI predictions are scored once pasted back (paste_batch()).
+    """
+    indices = np.asarray(indices)
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start:start + batch_size]
+        images, masks = index.batch(batch)
+        if crop:
+            images = crop_batch(images, index.origins(batch), index.roi_size)
+        if dtype:
+            images = normalize_batch(images, dtype=dtype, axis=norm_axis)
+        yield images, masks
+
+
+def make_dataset(index, indices, n_classes, batch_size=4, shuffle=False, seed=0, dtype=None, norm_axis=1,
+                 one_hot=True, prefetch=2, sampler=None, crop=False):
+    """
+    Streams (images, masks) batches of the given slice indices. See the module notes for dtype.
+    With one_hot=False the masks stay (N, H, W, 1) uint8 class ids, for sparse_categorical_crossentropy.
+    A ForegroundSampler, if given, decides the batches instead (indices & shuffle are then unused).
+    With crop=True (after index.compute_rois()) batches hold the lung ROIs only.
+    """
+    indices = np.asarray(indices)
+    height, width = index.input_shape if crop else index.shape
+    image_dtype = np.dtype(dtype) if dtype else index.dtype
+    epoch = [0]
+
+    def generate():
+        if sampler is not None:
+            batches = sampler.batches(epoch[0])
+        else:
+            order = np.random.RandomState(seed + epoch[0]).permutation(indices) if shuffle else indices
+            batches = (order[start:start + batch_size] for start in range(0, len(order), batch_size))
+        epoch[0] += 1
+        for batch in batches:
+            images, masks = index.batch(batch, crop=crop)
+            if dtype:
+                images = normalize_batch(images, dtype=dtype, axis=norm_axis)
+            yield images, masks
+
+    dataset = tf.data.Dataset.from_generator(
+        generate, output_types=(tf.as_dtype(image_dtype), tf.uint8),
+        output_shapes=((None, height, width, 1), (None, height, width, 1)))
+    if one_hot:
+        dataset = dataset.map(lambda x, y: (x, tf.one_hot(y[..., 0], n_classes)))
+    return dataset.prefetch(prefetch)
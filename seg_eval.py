@@ -1,6 +1,8 @@
 from tensorflow.keras.metrics import MeanIoU
 from seg_unet import multi_unet_model
-import math
+from keras_tflite import TFLiteEngine, to_classes, measure_latency
+import time
+import collections
 import numpy as np
 import tensorflow as tf
 
@@ -9,87 +11,101 @@ dir_models = 'seg_models\\'
 dir_metrics = '.\\metrics\\'
 
 
-def eval_unet(FNAME="", DATASET="", MODEL=None, BATCH=0, EPOCHS=0, CLASSES=None, NUM_IMS=0, IM_DIM=32, IM_CH=1,
-         TEST_IMS=None, TEST_MASKS=None, PRINT=False):
-
-    NUM_CLS = len(CLASSES)
-    if MODEL is None:
-        MODEL = multi_unet_model(n_classes=NUM_CLS, IMG_HEIGHT=IM_DIM, IMG_WIDTH=IM_DIM, IMG_CHANNELS=IM_CH)
-    IOU_keras = MeanIoU(num_classes=NUM_CLS)
-
-    ypred = MODEL.predict(TEST_IMS)
-    ypred_argmax = np.argmax(ypred, axis=3)
-
-    # Generates the confusion matrix.
-    IOU_keras.update_state(TEST_MASKS[:, :, :, 0], ypred_argmax)
-
-    text = ["=========================================",
-            "Dataset: " + DATASET,
-            "Num Images: " + str(NUM_IMS),
-            "Image Size: " + str(IM_DIM) + "x" + str(IM_DIM),
-            "Num Classes: " + str(NUM_CLS),
-            "Batch Size: " + str(BATCH) if BATCH > 0 else None,
-            "Epochs: " + str(EPOCHS) if EPOCHS > 0 else None,
-            "=========================================",
-            "Mean IoU = " + str(IOU_keras.result().numpy())
-            ]
-    while None in text:
-        text.remove(None)
-
-    # To calculate I0U for each class...
-    values = np.array(IOU_keras.get_weights()).reshape(NUM_CLS, NUM_CLS)
-
-    # Store metrics
-    TP, FP, FN, TN, IoU, Dice = [], [], [], [], [], []
-    meanDice = 0
-    for i in range(NUM_CLS):
-        TP.append(values[i, i])
-        fp, fn = 0, 0
-        for k in range(NUM_CLS):
-            if k != i:
-                fp += values[i, k]
-                fn += values[k, i]
-        FP.append(fp)
-        FN.append(fn)
-        IoU.append(TP[i] / (TP[i] + FP[i] + FN[i]))
-        text.append(CLASSES[i] + " IoU:\t\t " + str(IoU[i]))
-
-        Dice.append((2 * TP[i]) / ((2 * TP[i]) + FP[i] + FN[i]))
-        meanDice += Dice[i]
+class SparseMeanIoU(MeanIoU):
+    """MeanIoU of class-id labels (N, H, W, 1) against softmax outputs, for training on sparse masks."""
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        return super(SparseMeanIoU, self).update_state(y_true[..., 0], tf.argmax(y_pred, axis=-1), sample_weight)
+
+
+class ConfusionMatrix:
+    """
+    Confusion matrix (rows: true class, columns: predicted class), accumulated one batch at a time with np.bincount.
+    Slices can also be counted per group (e.g. per volume), so a test split of any size is evaluated in flat memory.
+    """
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.values = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.groups = {}
+
+    def update(self, y_true, y_pred, groups=None):
+        """y_true & y_pred: (N, H, W) class ids. groups: (N,) key of each slice, e.g. its volume."""
+        n = self.n_classes
+        codes = np.asarray(y_true).astype(np.int64).reshape(len(y_true), -1) * n + \
+            np.asarray(y_pred).astype(np.int64).reshape(len(y_pred), -1)
+        if groups is None:
+            self.values += np.bincount(codes.ravel(), minlength=n * n).reshape(n, n)
+            return
+        groups = np.asarray(groups)
+        for group in np.unique(groups):
+            values = np.bincount(codes[groups == group].ravel(), minlength=n * n).reshape(n, n)
+            self.values += values
+            self.groups[group.item()] = self.groups.get(group.item(), 0) + values
+
+
+def confusion_metrics(values):
+    """
+    Every per-class figure of a confusion matrix as arrays of length C. Mean IoU (like MeanIoU) & mean Dice only
+    average the classes present in either the masks or the predictions.
+    NOTE: FP (row i) & FN (column i) are kept as the figures have always been reported.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    tp = np.diag(values)
+    fp = values.sum(axis=1) - tp
+    fn = values.sum(axis=0) - tp
+    tn = values.sum() - tp - fp - fn
+    present = tp + fp + fn > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = tp / (tp + fp + fn)
+        dice = (2 * tp) / ((2 * tp) + fp + fn)
+    sensitivity = tp / np.maximum(tp + fn, 1)
+    specificity = tn / np.maximum(tn + fp, 1)
+    precision = tp / np.maximum(tp + fp, 1)
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn, 'iou': iou, 'dice': dice, 'sensitivity': sensitivity,
+            'specificity': specificity, 'precision': precision,
+            'gmean': np.sqrt(np.maximum(sensitivity * specificity, 0)),
+            'f2_score': (5 * precision * sensitivity) / np.maximum((4 * precision) + sensitivity, 1),
+            'mean_iou': float(iou[present].mean()) if present.any() else 0.0,
+            'mean_dice': float(dice[present].mean()) if present.any() else 0.0}
+
+
+def report(confusion, classes, header, volume_names=None):
+    """The text report of a ConfusionMatrix: per-class figures, then a line per volume (if counted per volume)."""
+    metrics = confusion_metrics(confusion.values)
+    text = header + ["Mean IoU = " + str(metrics['mean_iou'])]
+    for i, name in enumerate(classes):
+        text.append(name + " IoU:\t\t " + str(metrics['iou'][i]))
 
     text.append("-----------------------------------------")
-    text.append("Mean Dice = " + str(meanDice / NUM_CLS))
-    for i in range(NUM_CLS):
-        text.append(CLASSES[i] + " Dice:\t\t " + str(Dice[i]))
+    text.append("Mean Dice = " + str(metrics['mean_dice']))
+    for i, name in enumerate(classes):
+        text.append(name + " Dice:\t\t " + str(metrics['dice'][i]))
 
     text.append("=========================================")
-    num_vals = len(TP)
-    for i in range(num_vals):
+    for i, name in enumerate(classes):
         if i > 0:
             text.append("-----------------------------------------")
-        negatives = 0
-        for j in range(num_vals):
-            if j != i:
-                for k in range(num_vals):
-                    if k != i:
-                        negatives += values[j, k]
-        TN.append(negatives)
-
-        # Final metrics.
-        sensitivity = TP[i] / max((TP[i] + FN[i]), 1)
-        specificity = TN[i] / max((TN[i] + FP[i]), 1)
-        precision = TP[i] / max((TP[i] + FP[i]), 1)
-        gmean = math.sqrt(max(sensitivity * specificity, 0))
-        f2_score = (5 * precision * sensitivity) / max(((4 * precision) + sensitivity), 1)
-        text.append("For Class: \t\t" + CLASSES[i] + "...")
-        text.append("Sensitivity: \t" + str(sensitivity))
-        text.append("Specificity: \t" + str(specificity))
-        text.append("Precision: \t\t" + str(precision))
-        text.append("G-Mean Score: \t" + str(gmean))
-        text.append("F2-Score: \t\t" + str(f2_score))
-
+        text.append("For Class: \t\t" + name + "...")
+        text.append("Sensitivity: \t" + str(metrics['sensitivity'][i]))
+        text.append("Specificity: \t" + str(metrics['specificity'][i]))
+        text.append("Precision: \t\t" + str(metrics['precision'][i]))
+        text.append("G-Mean Score: \t" + str(metrics['gmean'][i]))
+        text.append("F2-Score: \t\t" + str(metrics['f2_score'][i]))
     text.append("=========================================")
 
+    metrics['volumes'] = {}
+    if confusion.groups:
+        text.append("Per Volume (Mean IoU, Mean Dice, IoU per class)...")
+        for group in sorted(confusion.groups):
+            name = volume_names[group] if volume_names is not None else str(group)
+            volume = confusion_metrics(confusion.groups[group])
+            metrics['volumes'][name] = volume
+            text.append(name + ": \t" + "{:.4f}\t{:.4f}\t".format(volume['mean_iou'], volume['mean_dice']) +
+                        " ".join("{:.4f}".format(v) for v in volume['iou']))
+        text.append("=========================================")
+    return text, metrics
+
+
+def write_report(text, FNAME, PRINT=False):
     PATH = 'C:\\Users\\elite\\PycharmProjects\\Pytorch\\' + dir_metrics + FNAME + '.txt'
     with open(PATH, 'w') as f:
         if PRINT:
@@ -99,89 +115,118 @@ def eval_unet(FNAME="", DATASET="", MODEL=None, BATCH=0, EPOCHS=0, CLASSES=None,
     f.close()
 
 
-def eval_tfl(TFLModel, FNAME="", DATASET="", CLASSES=None, IM_SIZE=0, X_TEST=None, Y_TEST=None):
-    N_CLASSES = len(CLASSES)
-
-    interpreter = tf.lite.Interpreter(model_content=TFLModel)
-    interpreter.allocate_tensors()
-
-    input_index = interpreter.get_input_details()[0]['index']
-    output_index = interpreter.get_output_details()[0]['index']
-    ypred = []
-    for img in X_TEST:
-        img = np.expand_dims(img, axis=0).astype(np.float32)
-        interpreter.set_tensor(input_index, img)
-
-        interpreter.invoke()
-
-        output = interpreter.get_tensor(output_index)
-        ypred.append(output[0])
-
-    ypred_argmax = np.argmax(np.array(ypred), axis=3)
-    IOU_keras = MeanIoU(num_classes=N_CLASSES)
-    IOU_keras.update_state(Y_TEST[:, :, :, 0], ypred_argmax)
-
-    text = ["=========================================",
-            "Dataset: " + DATASET,
-            "Image Size: " + str(IM_SIZE) + "x" + str(IM_SIZE),
-            "Num Classes: " + str(N_CLASSES),
-            "=========================================",
-            "Mean IoU = " + str(IOU_keras.result().numpy())
-            ]
-    values = np.array(IOU_keras.get_weights()).reshape(N_CLASSES, N_CLASSES)
-
-    # Store metrics
-    TP, FP, FN, TN, IoU, Dice = [], [], [], [], [], []
-    meanDice = 0
-    for i in range(N_CLASSES):
-        TP.append(values[i, i])
-        fp, fn = 0, 0
-        for k in range(N_CLASSES):
-            if k != i:
-                fp += values[i, k]
-                fn += values[k, i]
-        FP.append(fp)
-        FN.append(fn)
-        IoU.append(TP[i] / (TP[i] + FP[i] + FN[i]))
-        text.append(CLASSES[i] + " IoU:\t\t " + str(IoU[i]))
-
-        Dice.append((2 * TP[i]) / ((2 * TP[i]) + FP[i] + FN[i]))
-        meanDice += Dice[i]
-
-    text.append("-----------------------------------------")
-    text.append("Mean Dice = " + str(meanDice / N_CLASSES))
-    for i in range(N_CLASSES):
-        text.append(CLASSES[i] + " Dice:\t\t " + str(Dice[i]))
-
-    text.append("=========================================")
-    num_vals = len(TP)
-    for i in range(num_vals):
-        if i > 0:
-            text.append("-----------------------------------------")
-        negatives = 0
-        for j in range(num_vals):
-            if j != i:
-                for k in range(num_vals):
-                    if k != i:
-                        negatives += values[j, k]
-        TN.append(negatives)
-
-        # Final metrics.
-        sensitivity = TP[i] / max((TP[i] + FN[i]), 1)
-        specificity = TN[i] / max((TN[i] + FP[i]), 1)
-        precision = TP[i] / max((TP[i] + FP[i]), 1)
-        gmean = math.sqrt(max(sensitivity * specificity, 0))
-        f2_score = (5 * precision * sensitivity) / max(((4 * precision) + sensitivity), 1)
-        text.append("For Class: \t\t" + CLASSES[i] + "...")
-        text.append("Sensitivity: \t" + str(sensitivity))
-        text.append("Specificity: \t" + str(specificity))
-        text.append("Precision: \t\t" + str(precision))
-        text.append("G-Mean Score: \t" + str(gmean))
-        text.append("F2-Score: \t\t" + str(f2_score))
+def eval_unet(FNAME="", DATASET="", MODEL=None, BATCH=0, EPOCHS=0, CLASSES=None, NUM_IMS=0, IM_DIM=32, IM_CH=1,
+         TEST_IMS=None, TEST_MASKS=None, PRINT=False, TEST_DS=None, PASTE=None, PREDICT=None, VOLUMES=None,
+         VOLUME_NAMES=None):
+    # NOTE: TEST_MASKS are class ids (N, H, W, 1). TEST_IMS are predicted BATCH (or 16) slices at a time into a running
+    #       confusion matrix, so memory stays flat whatever the size of the test split. Instead of arrays, TEST_DS may
+    #       stream (images, masks) batches (e.g. seg_data.eval_batches()) with sparse or one-hot masks.
+    #       For a model on cropped ROIs, PASTE(pred, idx) maps the (n, h, w) predictions of test slices idx (a slice
+    #       over the whole split) back onto the full-size masks. PREDICT (e.g. seg_infer.TiledPredictor.predict) maps a
+    #       batch of images to (n, h, w) class ids in place of MODEL.
+    #       VOLUMES (N,) gives each slice's volume (named by VOLUME_NAMES) for a per-volume breakdown.
+    # Returns the metrics of confusion_metrics() (plus 'volumes').
 
-    text.append("=========================================")
+    NUM_CLS = len(CLASSES)
+    if MODEL is None and PREDICT is None:
+        MODEL = multi_unet_model(n_classes=NUM_CLS, IMG_HEIGHT=IM_DIM, IMG_WIDTH=IM_DIM, IMG_CHANNELS=IM_CH)
+    confusion = ConfusionMatrix(NUM_CLS)
 
-    PATH = 'C:\\Users\\elite\\PycharmProjects\\Pytorch\\' + dir_metrics + FNAME + '.txt'
-    with open(PATH, 'w') as f:
-        f.writelines('\n'.join(text))
-    f.close()
+    # Generates the confusion matrix.
+    if TEST_DS is None:
+        step = BATCH if BATCH > 0 else 16
+        TEST_DS = ((TEST_IMS[start:start + step], TEST_MASKS[start:start + step])
+                   for start in range(0, len(TEST_IMS), step))
+    count = 0
+    for images, masks in TEST_DS:
+        idx = slice(count, count + len(images))
+        count += len(images)
+        if PREDICT is not None:
+            ypred_argmax = PREDICT(images)
+        else:
+            ypred_argmax = np.argmax(MODEL.predict_on_batch(images), axis=3)
+        if PASTE is not None:
+            ypred_argmax = PASTE(ypred_argmax, idx)
+        masks = np.asarray(masks)
+        masks = masks[..., 0] if masks.shape[-1] == 1 else np.argmax(masks, axis=3)
+        confusion.update(masks, ypred_argmax, None if VOLUMES is None else VOLUMES[idx])
+
+    header = ["=========================================",
+              "Dataset: " + DATASET,
+              "Num Images: " + str(NUM_IMS),
+              "Image Size: " + str(IM_DIM) + "x" + str(IM_DIM),
+              "Num Classes: " + str(NUM_CLS),
+              "Batch Size: " + str(BATCH) if BATCH > 0 else None,
+              "Epochs: " + str(EPOCHS) if EPOCHS > 0 else None,
+              "========================================="
+              ]
+    while None in header:
+        header.remove(None)
+
+    text, metrics = report(confusion, CLASSES, header, VOLUME_NAMES)
+    write_report(text, FNAME, PRINT)
+    return metrics
+
+
+def eval_tfl(TFLModel, FNAME="", DATASET="", CLASSES=None, IM_SIZE=0, X_TEST=None, Y_TEST=None, PASTE=None,
+             PREDICT=None, VOLUMES=None, VOLUME_NAMES=None, BATCH=16, WORKERS=0, LATENCY_SAMPLE=None, TEST_DS=None):
+    # NOTE: PREDICT (e.g. a TiledPredictor over seg_infer.tflite_tiles) maps a batch of images to class ids in place of
+    #       TFLModel. PASTE, VOLUMES, VOLUME_NAMES & TEST_DS (in place of X_TEST & Y_TEST) work as in eval_unet().
+    #       TFLModel runs BATCH slices per invoke on every core, or over WORKERS interpreter processes (keras_tflite).
+    #       Besides IoU & co, the report has the model size, the single-input latency of TFLModel (on LATENCY_SAMPLE,
+    #       by default the first slices of the test split; e.g. tiles for a tile model) & the slices/s of the whole
+    #       evaluation.
+    N_CLASSES = len(CLASSES)
+    confusion = ConfusionMatrix(N_CLASSES)
+
+    if TEST_DS is None:
+        TEST_DS = ((X_TEST[start:start + BATCH], Y_TEST[start:start + BATCH]) for start in range(0, len(X_TEST), BATCH))
+    # Masks wait here for their predictions, the engine only reads a few batches ahead.
+    pending = collections.deque()
+    sample = [LATENCY_SAMPLE]
+
+    def images():
+        for x, y in TEST_DS:
+            if sample[0] is None and PREDICT is None:
+                sample[0] = x[:8]
+            pending.append(y)
+            yield x
+
+    engine = None
+    if PREDICT is None:
+        engine = TFLiteEngine(TFLModel, batch_size=BATCH, workers=WORKERS, postprocess=to_classes)
+        predictions = engine.map(images())
+    else:
+        predictions = (PREDICT(x) for x in images())
+
+    start = time.perf_counter()
+    count = 0
+    for ypred_argmax in predictions:
+        masks = pending.popleft()
+        idx = slice(count, count + len(ypred_argmax))
+        count += len(ypred_argmax)
+        if PASTE is not None:
+            ypred_argmax = PASTE(ypred_argmax, idx)
+        confusion.update(masks[..., 0], ypred_argmax, None if VOLUMES is None else VOLUMES[idx])
+    slices_per_s = count / max(time.perf_counter() - start, 1e-9)
+    if engine is not None:
+        engine.close()
+
+    latency = None if sample[0] is None else measure_latency(TFLModel, sample[0])
+
+    header = ["=========================================",
+              "Dataset: " + DATASET,
+              "Image Size: " + str(IM_SIZE) + "x" + str(IM_SIZE),
+              "Num Classes: " + str(N_CLASSES),
+              "Model Size: " + "{:,.1f}".format(len(TFLModel) / 1024.) + " KB",
+              "Latency: " + "{:.2f}".format(latency) + " ms / input" if latency is not None else None,
+              "Throughput: " + "{:.2f}".format(slices_per_s) + " slices / s",
+              "========================================="
+              ]
+    while None in header:
+        header.remove(None)
+
+    text, metrics = report(confusion, CLASSES, header, VOLUME_NAMES)
+    write_report(text, FNAME)
+    metrics.update({'size_kb': len(TFLModel) / 1024., 'latency_ms': latency, 'slices_per_s': slices_per_s})
+    return metrics
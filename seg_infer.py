@@ -0,0 +1,255 @@
+"""
+Tiled, sliding-window inference for the U-Net (Keras or TFLite).
+
+A slice is cut into overlapping tile x tile windows (stride = tile * (1 - overlap), with the last window flush against
+the border). Tiles of any number of slices are run through the model batch_size at a time, and each tile's softmax
+output is blended into the slice with a 2D Hann window, so tile borders (where the U-Net sees the least context) weigh
+the least. Memory is bounded by the tile batch plus the probabilities of the few slices in flight, whatever the slice
+size, and a batch of tiles keeps every core of a CPU busy.
+
+multi_unet_model() is fully convolutional, but its Preprocess layer may L2 normalize along the slice height, which
+would differ per tile. The tile models therefore take host-preprocessed float32 tiles:
+    - keras_tiles(model, tile):         a tile-sized copy of the U-Net sharing the model's weights.
+    - export_tile_tflite(model, tile):  the same copy, converted to TFLite (tflite_tiles() runs it).
+    - host_preprocess(model):           the model's own cast, rescale & normalize, applied to whole slices.
+
+CoarseToFine first runs a reduced-width U-Net (multi_unet_model(WIDTH=...)) on slices downsampled by an integer factor.
+Only slices (or, when tiling, only the tiles) where that coarse pass finds lesion classes get the full-resolution
+pass; everything else keeps the upsampled coarse prediction. It counts the convolution FLOPs spent against those of
+running the full-resolution model everywhere.
+"""
+import numpy as np
+from tensorflow.keras.layers import Conv2D, Conv2DTranspose
+from scipy import ndimage
+
+from seg_unet import multi_unet_model
+from keras_preprocess import Preprocess
+from keras_tflite import BatchedInterpreter, convert_tflite
+
+
+def tile_origins(size, tile, stride):
+    """Window starts along one axis, the last one flush with the border."""
+    if size <= tile:
+        return [0]
+    origins = list(range(0, size - tile, stride))
+    return origins + [size - tile]
+
+
+def blend_weights(tile, floor=1e-3):
+    """2D Hann window (tile, tile), floored so border pixels covered by a single tile still count."""
+    window = np.hanning(tile + 2)[1:-1]
+    return np.maximum(np.outer(window, window), floor).astype(np.float32)
+
+
+# =============================================================
+# NOTE TILED PREDICTOR
+# =============================================================
+class TiledPredictor:
+    def __init__(self, predict_batch, n_classes, tile=128, overlap=0.25, batch_size=16, preprocess=None):
+        """predict_batch maps (B, tile, tile, C) float32 tiles to (B, tile, tile, n_classes) probabilities."""
+        if not 0 <= overlap < 1:
+            raise ValueError('Tile overlap must be in [0, 1), got ' + str(overlap))
+        self.predict_batch = predict_batch
+        self.n_classes = n_classes
+        self.tile = tile
+        self.stride = max(1, int(round(tile * (1 - overlap))))
+        self.batch_size = batch_size
+        self.preprocess = preprocess
+        self.weights = blend_weights(tile)[..., np.newaxis]
+        self.tiles_run = 0
+        self.tiles_total = 0
+
+    def predict(self, images, tile_mask=None, fallback=None):
+        """
+        (N, H, W, C) slices -> (N, H, W) class ids.
+        With a (N, H, W) boolean tile_mask, only tiles overlapping it are run, & pixels no tile covers take the class
+        ids of fallback (N, H, W).
+        """
+        images = np.asarray(images)
+        n, height, width = images.shape[:3]
+
+        # Slices smaller than a tile are zero-padded up to it (and cropped back afterwards).
+        pad_h, pad_w = max(self.tile - height, 0), max(self.tile - width, 0)
+        origins = [(y, x) for y in tile_origins(height + pad_h, self.tile, self.stride)
+                   for x in tile_origins(width + pad_w, self.tile, self.stride)]
+
+        # Enough slices per chunk to fill a batch of tiles, so only their probabilities are ever held.
+        per_chunk = max(1, -(-self.batch_size // len(origins)))
+        classes = np.empty((n, height, width), dtype=np.uint8)
+        for start in range(0, n, per_chunk):
+            chunk = images[start:start + per_chunk]
+            if self.preprocess is not None:
+                chunk = self.preprocess(chunk)
+            chunk = np.pad(chunk.astype(np.float32), ((0, 0), (0, pad_h), (0, pad_w), (0, 0)))
+            mask = None
+            if tile_mask is not None:
+                mask = np.pad(tile_mask[start:start + per_chunk], ((0, 0), (0, pad_h), (0, pad_w)))
+            acc, norm = self._predict_chunk(chunk, origins, mask)
+
+            covered = norm[:, :height, :width, 0] > 0
+            chunk_classes = np.argmax(acc[:, :height, :width], axis=-1).astype(np.uint8)
+            if fallback is not None:
+                chunk_classes = np.where(covered, chunk_classes, fallback[start:start + len(chunk)])
+            classes[start:start + len(chunk)] = chunk_classes
+        return classes
+
+    def _predict_chunk(self, chunk, origins, mask=None):
+        """Blended (not yet normalized) class scores & blend weights of a chunk of padded slices."""
+        tile = self.tile
+        acc = np.zeros(chunk.shape[:3] + (self.n_classes,), dtype=np.float32)
+        norm = np.zeros(chunk.shape[:3] + (1,), dtype=np.float32)
+        jobs = [(i, y, x) for i in range(len(chunk)) for y, x in origins]
+        self.tiles_total += len(jobs)
+        if mask is not None:
+            jobs = [(i, y, x) for i, y, x in jobs if mask[i, y:y + tile, x:x + tile].any()]
+        self.tiles_run += len(jobs)
+
+        for start in range(0, len(jobs), self.batch_size):
+            batch = jobs[start:start + self.batch_size]
+            tiles = np.stack([chunk[i, y:y + tile, x:x + tile] for i, y, x in batch])
+            probs = self.predict_batch(tiles)
+            for (i, y, x), p in zip(batch, probs):
+                acc[i, y:y + tile, x:x + tile] += p * self.weights
+                norm[i, y:y + tile, x:x + tile] += self.weights
+        return acc, norm
+
+
+# =============================================================
+# NOTE MODEL ADAPTERS
+# =============================================================
+def find_preprocess(model):
+    for layer in model.layers:
+        if isinstance(layer, Preprocess):
+            return layer
+    return None
+
+
+def host_preprocess(model):
+    """The Preprocess step of a model as a NumPy function on whole (N, H, W, C) slices, or None."""
+    layer = find_preprocess(model)
+    if layer is None:
+        return None
+
+    def preprocess(x):
+        x = x.astype(np.float32) * layer.scale + layer.offset
+        if layer.l2_axis is not None:
+            norm = np.sqrt(np.sum(x * x, axis=layer.l2_axis, keepdims=True))
+            x = x / np.where(norm == 0, 1, norm)
+        return x
+    return preprocess
+
+
+def tile_model(model, tile):
+    """A (tile x tile) U-Net with the model's weights, taking already preprocessed float32 input."""
+    n_channels = model.input_shape[-1]
+    n_classes = model.output_shape[-1]
+    width = [layer for layer in model.layers if isinstance(layer, Conv2D)][0].filters / 16.0
+    tiled = multi_unet_model(n_classes=n_classes, IMG_HEIGHT=tile, IMG_WIDTH=tile, IMG_CHANNELS=n_channels,
+                             INPUT_DTYPE='float32', WIDTH=width)
+    tiled.set_weights(model.get_weights())
+    return tiled
+
+
+def keras_tiles(model, tile):
+    tiled = tile_model(model, tile)
+    return lambda tiles: tiled.predict_on_batch(tiles)
+
+
+def export_tile_tflite(model, tile, mode='none', representative=None, io_dtype='uint8'):
+    """keras_tflite.convert_tflite() of the tile model. An int8 representative dataset must yield preprocessed tiles."""
+    return convert_tflite(tile_model(model, tile), mode=mode, representative=representative, io_dtype=io_dtype)
+
+
+def tflite_tiles(tflite_model, batch_size=16, num_threads=None):
+    """Runs a tile-sized TFLite export on whole batches of tiles (the last, short batch is zero-padded)."""
+    return BatchedInterpreter(tflite_model, batch_size=batch_size, num_threads=num_threads).invoke
+
+
+# =============================================================
+# NOTE COARSE-TO-FINE
+# =============================================================
+def conv_flops(model):
+    """Multiply-adds of every (transposed) convolution of a Keras model, for one input."""
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, (Conv2D, Conv2DTranspose)):
+            k_h, k_w = layer.kernel_size
+            out_h, out_w = layer.output_shape[1:3]
+            in_ch = layer.input_shape[-1]
+            if isinstance(layer, Conv2DTranspose):
+                out_h, out_w = layer.input_shape[1:3]       # Each input pixel scatters one kernel.
+            flops += out_h * out_w * k_h * k_w * in_ch * layer.filters
+    return flops
+
+
+def coarse_shape(shape, factor, multiple=16):
+    """(height, width) of the coarse model for slices of the given shape, rounded up so its pooling steps divide it."""
+    return tuple(-(-size // (factor * multiple)) * multiple for size in shape[:2])
+
+
+def downsample(images, factor, multiple=16):
+    """Block mean of (N, H, W, C) slices by an integer factor, zero-padded up to coarse_shape() first."""
+    n, height, width, channels = images.shape
+    coarse_h, coarse_w = coarse_shape((height, width), factor, multiple)
+    images = np.pad(images.astype(np.float32), ((0, 0), (0, coarse_h * factor - height),
+                                                (0, coarse_w * factor - width), (0, 0)))
+    return images.reshape(n, coarse_h, factor, coarse_w, factor, channels).mean(axis=(2, 4))
+
+
+def upsample(classes, factor):
+    return classes.repeat(factor, axis=1).repeat(factor, axis=2)
+
+
+class CoarseToFine:
+    def __init__(self, coarse_predict, fine_predict, factor, coarse_flops, fine_flops, lesion_classes=(1, 2, 3),
+                 min_pixels=1, margin=8, multiple=16):
+        """
+        coarse_predict: (N, H / factor, W / factor, C) float32 -> (N, H / factor, W / factor) class ids.
+        fine_predict:   a TiledPredictor (only lesion tiles are run), or (N, H, W, C) -> (N, H, W) class ids.
+        coarse_flops & fine_flops: cost of one coarse slice, & of one fine slice (or tile, for a TiledPredictor).
+        A slice is refined when the coarse pass finds at least min_pixels lesion pixels (at full resolution); tiles
+        are refined when they overlap those pixels, grown by margin.
+        multiple: the coarse model's size divisor (see coarse_shape()).
+        """
+        self.coarse_predict = coarse_predict
+        self.fine_predict = fine_predict
+        self.factor = factor
+        self.coarse_flops = coarse_flops
+        self.fine_flops = fine_flops
+        self.lesion_classes = list(lesion_classes)
+        self.min_pixels = min_pixels
+        self.margin = margin
+        self.multiple = multiple
+        self.spent = 0
+        self.full = 0
+
+    def predict(self, images):
+        images = np.asarray(images)
+        height, width = images.shape[1:3]
+        coarse = self.coarse_predict(downsample(images, self.factor, self.multiple))
+        coarse = upsample(coarse, self.factor)[:, :height, :width].astype(np.uint8)
+        lesion = np.isin(coarse, self.lesion_classes)
+        refine = lesion.reshape(len(lesion), -1).sum(axis=1) >= self.min_pixels
+        self.spent += len(images) * self.coarse_flops
+
+        if isinstance(self.fine_predict, TiledPredictor):
+            lesion &= refine[:, np.newaxis, np.newaxis]
+            if self.margin:
+                lesion = ndimage.binary_dilation(lesion, structure=np.ones((1, 3, 3), dtype=bool),
+                                                 iterations=self.margin)
+            run, total = self.fine_predict.tiles_run, self.fine_predict.tiles_total
+            classes = self.fine_predict.predict(images, tile_mask=lesion, fallback=coarse)
+            self.spent += (self.fine_predict.tiles_run - run) * self.fine_flops
+            self.full += (self.fine_predict.tiles_total - total) * self.fine_flops
+            return classes
+
+        classes = coarse
+        if refine.any():
+            classes[refine] = self.fine_predict(images[refine])
+        self.spent += int(refine.sum()) * self.fine_flops
+        self.full += len(images) * self.fine_flops
+        return classes
+
+    def skipped(self):
+        """Fraction of the full-resolution compute saved so far (negative if the coarse pass costs more)."""
+        return 1.0 - self.spent / float(max(self.full, 1))
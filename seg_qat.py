@@ -0,0 +1,97 @@
+"""
+Quantization-aware training (QAT) for the U-Net.
+
+quantize_unet() wraps a trained multi_unet_model() with fake-quant ops (tfmot), so fine-tuning learns weights that
+hold up once the model runs in int8. The layers are handled as follows:
+    - Conv2D, MaxPooling2D, Dropout:   tfmot's default 8-bit configs.
+    - concatenate (skip connections):  default config; tfmot's layout transforms give every input of a concatenate the
+                                       same quantization range, which the int8 CONCATENATION kernel requires.
+    - Conv2DTranspose:                 TransposeQuantizeConfig, 8-bit per-tensor kernel & output, so older tfmot
+                                       versions without a default config for it work too.
+    - Preprocess:                      OutputQuantizeConfig: no weights, only its (normalized) output is quantized.
+The fake-quant model takes float32 input (keras_tflite.float_input()), as the int8 converter must calibrate it. Where
+tfmot has it, the pruning-preserving scheme keeps the pruned weights at zero while fine-tuning.
+"""
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2DTranspose
+import tensorflow_model_optimization as tfmot
+
+from keras_preprocess import Preprocess
+from keras_tflite import float_input
+
+quantize = tfmot.quantization.keras
+LastValueQuantizer = quantize.quantizers.LastValueQuantizer
+MovingAverageQuantizer = quantize.quantizers.MovingAverageQuantizer
+
+
+class OutputQuantizeConfig(quantize.QuantizeConfig):
+    """Quantizes only a layer's output (8 bits, moving-average range)."""
+    def get_weights_and_quantizers(self, layer):
+        return []
+
+    def get_activations_and_quantizers(self, layer):
+        return []
+
+    def set_quantize_weights(self, layer, quantize_weights):
+        pass
+
+    def set_quantize_activations(self, layer, quantize_activations):
+        pass
+
+    def get_output_quantizers(self, layer):
+        return [MovingAverageQuantizer(num_bits=8, per_axis=False, symmetric=False, narrow_range=False)]
+
+    def get_config(self):
+        return {}
+
+
+class TransposeQuantizeConfig(quantize.QuantizeConfig):
+    """8-bit symmetric per-tensor kernel & 8-bit output of a Conv2DTranspose."""
+    def get_weights_and_quantizers(self, layer):
+        return [(layer.kernel, LastValueQuantizer(num_bits=8, per_axis=False, symmetric=True, narrow_range=True))]
+
+    def get_activations_and_quantizers(self, layer):
+        return [(layer.activation, MovingAverageQuantizer(num_bits=8, per_axis=False, symmetric=False,
+                                                          narrow_range=False))]
+
+    def set_quantize_weights(self, layer, quantize_weights):
+        layer.kernel = quantize_weights[0]
+
+    def set_quantize_activations(self, layer, quantize_activations):
+        layer.activation = quantize_activations[0]
+
+    def get_output_quantizers(self, layer):
+        return []
+
+    def get_config(self):
+        return {}
+
+
+# Needed to build (or load) a model annotated with these configs.
+QUANTIZE_OBJECTS = {'Preprocess': Preprocess, 'OutputQuantizeConfig': OutputQuantizeConfig,
+                    'TransposeQuantizeConfig': TransposeQuantizeConfig}
+
+
+def annotate_layer(layer):
+    if isinstance(layer, Preprocess):
+        return quantize.quantize_annotate_layer(layer, OutputQuantizeConfig())
+    if isinstance(layer, Conv2DTranspose):
+        return quantize.quantize_annotate_layer(layer, TransposeQuantizeConfig())
+    return quantize.quantize_annotate_layer(layer)
+
+
+def quantize_unet(model, weights=None, preserve_sparsity=True):
+    """
+    The fake-quant (QAT) version of a U-Net, starting from its weights. weights (e.g. another QAT model's
+    get_weights()) replace them, e.g. to carry a fine-tuned QAT model over to a tile-sized copy.
+    """
+    annotated = tf.keras.models.clone_model(float_input(model), clone_function=annotate_layer)
+    scheme = getattr(getattr(tfmot, 'experimental', None), 'combine', None)
+    with quantize.quantize_scope(QUANTIZE_OBJECTS):
+        if preserve_sparsity and hasattr(scheme, 'Default8BitPrunePreserveQuantizeScheme'):
+            qat_model = quantize.quantize_apply(annotated, scheme.Default8BitPrunePreserveQuantizeScheme())
+        else:
+            qat_model = quantize.quantize_apply(annotated)
+    if weights is not None:
+        qat_model.set_weights(weights)
+    return qat_model
@@ -9,6 +9,17 @@ REFERENCES:
     Medical Segmentation        (For provided Dataset ~ https://medicalsegmentation.com/covid19/)
     GitHub user Milesial        (Training, Testing, and logging routine templates ~ https://github.com/milesial)
     Dr. Sreenivas Bhattiprolu   (YouTube: 208 Multiclass semantic segmentation with U-Net)
+
+USAGE:
+    python seg_run.py                           Runs every stage: prepare, train, prune, export, quantize, evaluate.
+    python seg_run.py evaluate --eval tflite    Re-runs one stage, (re)building only the artifacts it is missing.
+    python seg_run.py --weights seg_models/MedSeg.hdf5      Starts from already trained weights instead of training.
+    python seg_run.py evaluate --eval c2f       Coarse-to-fine inference (trains the small coarse model if missing).
+    python seg_run.py evaluate --eval int8 float16 quant    Compares the TFLite quantization variants.
+    python seg_run.py evaluate --eval qat int8  Quantization-aware trained int8 model against post-training int8.
+Every stage writes one artifact to seg_models/stages/, named by a digest of its settings & of its inputs' digests.
+A stage whose artifact already exists is skipped, so e.g. evaluating the TFLite models again reads the cached split
+& .tflite files and streams the test slices, without re-splitting the dataset or rebuilding a Keras model.
 """
 
 # ===================================================
@@ -16,8 +27,11 @@ REFERENCES:
 # ===================================================
 # OS & Environment setup
 import os
+import json
+import shutil
+import hashlib
+import argparse
 import logging
-import tifffile
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -28,8 +42,16 @@ logging.getLogger('tensorflow').setLevel(logging.FATAL)
 import matplotlib.pyplot as plt
 import numpy as np
 from seg_unet import multi_unet_model
+from seg_data import SliceIndex, ForegroundSampler, make_dataset, normalize_batch, list_tiffs
+from seg_data import eval_batches, paste_batch
+from seg_infer import TiledPredictor, keras_tiles, tflite_tiles, export_tile_tflite
+from seg_infer import CoarseToFine, coarse_shape, conv_flops, tile_model
+from seg_qat import quantize_unet
+from keras_tflite import convert_tflite
+from keras_preprocess import CUSTOM_OBJECTS
 from seg_eval import eval_unet
 from seg_eval import eval_tfl
+from seg_eval import SparseMeanIoU
 
 # Tensorflow Imports
 import tensorflow as tf
@@ -37,12 +59,9 @@ from tensorflow import lite
 import tensorflow_model_optimization as tfmot
 import tensorflow.compat.v1 as tf_v1
 
-# Keras, Metrics, and LabelEncoder
+# Keras & Metrics
 from tensorflow.python.keras import backend as K
-from tensorflow.keras.utils import normalize
-from tensorflow.keras.utils import to_categorical
 import tensorflow.keras.metrics
-from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from sklearn.utils import class_weight
 
@@ -54,44 +73,30 @@ dir_medseg = './data/MedSeg/'
 dir_sandstone = 'C:/Users/elite/Desktop/sandstone_data_for_ML/full_labels_for_deep_learning/128_patches/'
 dir_models = 'seg_models/'
 dir_metrics = './metrics/'
-
+dir_stages = dir_models + 'stages/'
 
 # Other global variables
 DEVICE = '/physical_device:GPU:0'
-config = tf_v1.ConfigProto(device_count={'GPU': 1, 'CPU': 8})
-K.set_session(tf_v1.Session(config=config))
 
 # =============================================================
 # STEP: Model Parameters
 # =============================================================
 
-TRAIN_IMAGS = []
-TRAIN_MASKS = []
-
 # dir_ims = "images/"
 # dir_masks = "masks/"
 dir_ims = "images1/"
 dir_masks = "masks1/"
 
-# Read from TIFF images (MedSeg).
+# Index the TIFF slices (MedSeg). Volumes are memory-mapped, slices are only read as batches stream through.
+# NOTE: Masks are served from a 2-bit packed store (written next to the masks on first use).
 DATASET = "MedSeg"
-for tif in os.listdir(dir_medseg + dir_ims):
-    ims = np.array(tifffile.imread(dir_medseg + dir_ims + tif))
-    for img in ims:
-        TRAIN_IMAGS.append(img)
-for tif in os.listdir(dir_medseg + dir_masks):
-    masks = np.array(tifffile.imread(dir_medseg + dir_masks + tif)).astype(np.int8)
-    for img in masks:
-        TRAIN_MASKS.append(img)
-TRAIN_IMAGS = np.asarray(TRAIN_IMAGS)
-TRAIN_MASKS = np.asarray(TRAIN_MASKS).astype(np.int8)
+dir_data = dir_medseg
 IM_SIZE = 512
 CLASSES = ["Backgnd/Misc", 'Ground Glass', 'Consolidation', 'Pleural Eff.']
 
-# Read from TIFF images (Sandstone).
+# Index the TIFF slices (Sandstone). NOTE: Move images.tiff & masks.tiff into their own images/ & masks/ folders.
 # DATASET = "Sandstone"
-# TRAIN_IMAGS = np.array(tifffile.imread(dir_sandstone + "images.tiff"))
-# TRAIN_MASKS = np.array(tifffile.imread(dir_sandstone + "masks.tiff")).astype(np.int8)
+# dir_data, dir_ims, dir_masks = dir_sandstone, "images/", "masks/"
 # IM_SIZE = 128       # Due to 128 x 128 patch images.
 # CLASSES = ["Backgd", 'Clay', 'Quartz', 'Pyrite']
 
@@ -102,77 +107,262 @@ BATCH_SIZE = 4      # Selected for RTX 2060
 VERBOSITY = 2       # One Line/Epoch
 # SHUFFLE = True
 SHUFFLE = False
-OPTIMIZER = tf.keras.optimizers.Adam(lr=0.0005)
-# OPTIMIZER = "adam"
-
-# =============================================================
-# STEP: Encoding & Pre-processing.
-# =============================================================
-# plt.imshow(TRAIN_IMAGS[24], cmap="gray")
-# plt.show()
-# plt.imshow(TRAIN_MASKS[24])
-# plt.show()
-
-# Assign labels & encode them.
-labeler = LabelEncoder()
-n, h, w = TRAIN_MASKS.shape
-reshaped_masks = TRAIN_MASKS.reshape(-1, 1)
-encoded_masks = labeler.fit_transform(reshaped_masks)
-updated_masks = encoded_masks.reshape(n, h, w)
-
-# Prepare training datasets.
-TRAIN_IMAGS = np.expand_dims(TRAIN_IMAGS, axis=3)
-TRAIN_IMAGS = normalize(TRAIN_IMAGS, axis=1)            # NOTE: Normalization step
-input_masks = np.expand_dims(updated_masks, axis=3)
-
-# Create training & testing datasets.
+LEARNING_RATE = 0.0005
+
+# SELECT: Sparse (class id) masks, or one-hot masks (N_CLASSES x larger, as float32).
+SPARSE_LABELS = True
+# SPARSE_LABELS = False
+LOSS = 'sparse_categorical_crossentropy' if SPARSE_LABELS else 'categorical_crossentropy'
+IOU_METRIC = SparseMeanIoU if SPARSE_LABELS else tf.keras.metrics.MeanIoU
+
+# NOTE: Masks are encoded per batch onto 0..N-1 (sorted mask values, as LabelEncoder did) through a cached LUT.
+#       Images keep their raw dtype, the normalization step (L2, axis=1) runs as the model's first layer.
+# SELECT: Batch normalization dtype for models without in-graph preprocessing (None, 'float32' or 'float16').
+NORM_DTYPE = None
+
+# SELECT: Foreground-aware sampling: at most MAX_EMPTY of a batch are background-only slices, & slices of rare classes
+#         are oversampled ((1 / n) ** CLASS_POWER, for a class seen in n slices). None trains on every slice uniformly.
+MAX_EMPTY = 0.25
+# MAX_EMPTY = None
+CLASS_POWER = 0.5
+
+# SELECT: Train & infer on lung ROIs: one window per volume around its lungs (plus ROI_MARGIN pixels), rounded up to a
+#         multiple of 16. Predictions are pasted back into full-size masks for evaluation.
+CROP_ROI = True
+# CROP_ROI = False
+ROI_MARGIN = 8
+
+# SELECT: Tiled inference: slices (or ROIs) run as batches of overlapping TILE x TILE windows, blended back together.
+#         The TFLite exports are then tile-sized. None runs whole slices.
+TILE = None
+# TILE = 128
+TILE_OVERLAP = 0.25
+TILE_BATCH = 16
+
+# SELECT: TFLite evaluation: TFL_BATCH slices per invoke, over TFL_WORKERS interpreter processes sharing the cores
+#         (0 runs a single interpreter on every core).
+TFL_BATCH = 4
+TFL_WORKERS = 2
+
+# SELECT: Full-integer (int8) export: calibrated on N_REPRESENTATIVE training slices, with INT8_IO ('uint8' or 'int8')
+#         input & output. The dynamic-range ('quantize') & float16 exports need no calibration.
+# NOTE: Raw HU slices would quantize to ~12 HU per uint8 step before the in-graph L2 normalize, so models taking raw
+#       slices keep float input & output (None). Host-normalized input (NORM_DTYPE) is quantized on the host.
+N_REPRESENTATIVE = 200
+INT8_IO = 'uint8' if NORM_DTYPE else None
+
+# SELECT: Quantization-aware training ('qat' stage): the pruned U-Net is fine-tuned with fake-quant ops for QAT_EPOCHS,
+#         then exported as a full-int8 model (with INT8_IO input & output).
+QAT_EPOCHS = 3
+QAT_LEARNING_RATE = 0.0001
+
+# SELECT: Coarse-to-fine inference ('--eval c2f'): a COARSE_WIDTH-wide U-Net runs on slices downsampled COARSE_SCALE
+#         times, & the full model only re-runs slices (or tiles, with TILE) where it found lesions (grown by
+#         COARSE_MARGIN pixels). The coarse model is trained by its own 'coarse' stage.
+COARSE_SCALE = 4
+COARSE_WIDTH = 0.25
+COARSE_EPOCHS = 30
+COARSE_MARGIN = 8
+
+# Testing split & pruning schedule.
 N_TEST = 0.1
-x_train, x_test, y_train, y_test = train_test_split(TRAIN_IMAGS, input_masks, test_size=N_TEST, random_state=0)
+SPLIT_SEED = 0
+PRUNE_EPOCHS = 2
+FINAL_SPARSITY = 0.50
+VALIDATION_SPLIT = 0.1      # 10% of training set will be used for validation set.
 
-# NOTE: Sanity check
-# print("Class values in the dataset are ... ", np.unique(y_train))
-
-# Categorize by one-hot encoding.
-masks_cat_train = to_categorical(y_train, num_classes=N_CLASSES)
-y_train_cat = masks_cat_train.reshape((y_train.shape[0], y_train.shape[1], y_train.shape[2], N_CLASSES))
-masks_cat_test = to_categorical(y_test, num_classes=N_CLASSES)
-y_test_cat = masks_cat_test.reshape((y_test.shape[0], y_test.shape[1], y_test.shape[2], N_CLASSES))
+IM_CH = 1
 
 # NOTE: Calculate class weights.
-# weights = class_weight.compute_class_weight('balanced', np.unique(encoded_masks), encoded_masks)
+# weights = class_weight.compute_class_weight('balanced', SLICES.classes, encoded_masks)
 # weights = [0.00000000001, 1, 15, 10000000000000000]
 # weights = [0.00000001, 100, 1000, 10000]
 # weights = [0.00000001, 1, 10, 1000000000]
 # print("Class weights are...:", weights, "\n")
+CLASS_WEIGHTS = None
 
-IM_HT = x_train.shape[1]
-IM_WD = x_train.shape[2]
-IM_CH = x_train.shape[3]
 
+def get_model(im_shape, im_dtype):
+    return multi_unet_model(n_classes=N_CLASSES, IMG_HEIGHT=im_shape[0], IMG_WIDTH=im_shape[1], IMG_CHANNELS=IM_CH,
+                            INPUT_DTYPE=NORM_DTYPE or im_dtype, L2_AXIS=None if NORM_DTYPE else 1)
 
-def get_model():
-    return multi_unet_model(n_classes=N_CLASSES, IMG_HEIGHT=IM_HT, IMG_WIDTH=IM_WD, IMG_CHANNELS=IM_CH)
+
+def get_coarse_model(im_shape):
+    height, width = coarse_shape(im_shape, COARSE_SCALE)
+    return multi_unet_model(n_classes=N_CLASSES, IMG_HEIGHT=height, IMG_WIDTH=width, IMG_CHANNELS=IM_CH,
+                            INPUT_DTYPE='float32', L2_AXIS=None if NORM_DTYPE else 1, WIDTH=COARSE_WIDTH)
+
+
+def get_sampler(split):
+    if MAX_EMPTY is None:
+        return None
+    sampler = ForegroundSampler(split['histograms'], split['idx_train'], batch_size=BATCH_SIZE, max_empty=MAX_EMPTY,
+                                class_power=CLASS_POWER)
+    print("Background-only slices:\t {:.1%}".format(sampler.empty_share), "of training split, capped at",
+          "{:.0%}".format(MAX_EMPTY), "per batch")
+    return sampler
+
+
+def load_split(path):
+    """
+    The split of the prepare stage (train/test slice indices), the slice index, test(batch_size) & paste.
+    test() streams the test split as (model input, full-size mask) batches: ROIs when cropping, normalized with
+    NORM_DTYPE. paste (or None) maps ROI predictions back onto the full-size masks.
+    """
+    split = np.load(path)
+    slices = SliceIndex(dir_data + dir_ims, dir_data + dir_masks, packed_masks=True)
+    if CROP_ROI:
+        slices.compute_rois(margin=ROI_MARGIN)
+    test = lambda batch_size=16: eval_batches(slices, split['idx_test'], batch_size=batch_size, dtype=NORM_DTYPE,
+                                              crop=CROP_ROI)
+    paste = None
+    if CROP_ROI:
+        origins = split['test_origins']
+        paste = lambda pred, idx=slice(None): paste_batch(pred, origins[idx], slices.shape)
+    return split, slices, test, paste
+
+
+def test_volumes(split):
+    """Volume of each test slice & the volume names, for per-volume metrics (None, None for older splits)."""
+    if 'test_volumes' not in split.files:
+        return None, None
+    return split['test_volumes'], [str(name) for name in split['volume_names']]
+
+
+# =============================================================
+# STEP: Stage Artifacts
+# =============================================================
+STAGES = ['prepare', 'train', 'prune', 'export', 'quantize', 'float16', 'int8', 'qat', 'evaluate']
+OPTIONAL_STAGES = ['coarse']        # Only run when asked for, or needed by an evaluation.
+EXTENSIONS = {'prepare': '.npz', 'train': '.hdf5', 'prune': '.hdf5', 'export': '.tflite', 'quantize': '.tflite',
+              'float16': '.tflite', 'int8': '.tflite', 'qat': '.tflite', 'coarse': '.hdf5', 'evaluate': '.json'}
+EVAL_TARGETS = {'keras': ['prune'], 'tflite': ['export'], 'quant': ['quantize'], 'float16': ['float16'],
+                'int8': ['int8'], 'qat': ['qat'], 'c2f': ['prune', 'coarse']}
+DEFAULT_EVAL = ['float16', 'int8', 'keras', 'qat', 'quant', 'tflite']
+
+# TFLite stages: quantization mode (keras_tflite.QUANT_MODES), & their evaluation: stage, metrics file & title.
+QUANT_STAGES = {'export': 'none', 'quantize': 'dynamic', 'float16': 'float16', 'int8': 'int8'}
+TFLITE_TARGETS = {'tflite': ('export', "un_metrics_pruned_tfl", "Pruned TFLite Model"),
+                  'quant': ('quantize', "un_metrics_pq_tfl", "Pruned & Quantized TFLite Model"),
+                  'float16': ('float16', "un_metrics_pq_f16_tfl", "Pruned & Float16 TFLite Model"),
+                  'int8': ('int8', "un_metrics_pq_int8_tfl", "Pruned & Int8 TFLite Model"),
+                  'qat': ('qat', "un_metrics_qat_int8_tfl", "Pruned & QAT Int8 TFLite Model")}
+
+# Each stage's artifact is also published under its usual name in dir_models.
+PUBLISHED = {'train': DATASET + ".hdf5", 'prune': DATASET + "_pruned.hdf5", 'export': DATASET + '_pruned.tflite',
+             'quantize': DATASET + '_pq.tflite', 'float16': DATASET + '_pq_f16.tflite',
+             'int8': DATASET + '_pq_int8.tflite', 'qat': DATASET + '_qat_int8.tflite'}
+
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def tiff_signature(directory):
+    """Names, sizes & modification times of a folder's volumes: stands in for hashing gigabytes of TIFFs."""
+    return [[f, os.path.getsize(directory + f), os.stat(directory + f).st_mtime_ns] for f in list_tiffs(directory)]
+
+
+def stage_keys(args):
+    """Digest of every stage, chained from its settings & its inputs' digests, computed without running anything."""
+    keys = {'prepare': digest('prepare', DATASET, N_TEST, SPLIT_SEED, CROP_ROI, ROI_MARGIN,
+                              tiff_signature(dir_data + dir_ims),
+                              tiff_signature(dir_data + dir_masks))}
+    source = file_digest(args.weights) if args.weights else [EPOCHS, BATCH_SIZE, LEARNING_RATE, SHUFFLE, SPARSE_LABELS,
+                                                            CLASS_WEIGHTS, MAX_EMPTY, CLASS_POWER]
+    keys['train'] = digest('train', keys['prepare'], NORM_DTYPE, source)
+    keys['prune'] = digest('prune', keys['train'], PRUNE_EPOCHS, FINAL_SPARSITY, BATCH_SIZE)
+    keys['export'] = digest('export', keys['prune'], TILE)
+    keys['quantize'] = digest('quantize', keys['prune'], 'dynamic', TILE)
+    keys['float16'] = digest('float16', keys['prune'], TILE)
+    keys['int8'] = digest('int8', keys['prune'], keys['prepare'], TILE, N_REPRESENTATIVE, INT8_IO)
+    keys['qat'] = digest('qat', keys['prune'], keys['prepare'], TILE, N_REPRESENTATIVE, INT8_IO, QAT_EPOCHS,
+                         QAT_LEARNING_RATE, BATCH_SIZE, SHUFFLE, SPARSE_LABELS, MAX_EMPTY, CLASS_POWER)
+    keys['coarse'] = digest('coarse', keys['prepare'], NORM_DTYPE, COARSE_SCALE, COARSE_WIDTH, COARSE_EPOCHS,
+                            BATCH_SIZE, LEARNING_RATE, SHUFFLE, MAX_EMPTY, CLASS_POWER)
+    keys['evaluate'] = digest('evaluate', keys['prepare'], sorted(args.eval), TILE, TILE_OVERLAP, TILE_BATCH,
+                              COARSE_MARGIN if 'c2f' in args.eval else None,
+                              [keys[dep] for target in sorted(args.eval) for dep in EVAL_TARGETS[target]])
+    return keys
+
+
+def depends_on(stage, args):
+    if stage == 'evaluate':
+        return ['prepare'] + [dep for target in args.eval for dep in EVAL_TARGETS[target]]
+    return {'prepare': [], 'train': ['prepare'], 'prune': ['prepare', 'train'], 'export': ['prune'],
+            'quantize': ['prune'], 'float16': ['prune'], 'int8': ['prepare', 'prune'],
+            'qat': ['prepare', 'prune'], 'coarse': ['prepare']}[stage]
+
+
+# =============================================================
+# STEP: Prepare (Index, Encode & Split)
+# =============================================================
+def stage_prepare(out, paths):
+    # Indexing also writes the mask LUT & the packed mask store when they are missing.
+    slices = SliceIndex(dir_data + dir_ims, dir_data + dir_masks, packed_masks=True)
+
+    # NOTE: Sanity check
+    # print("Class values in the dataset are ... ", slices.classes)
+
+    # Create training & testing splits on slice indices. Only indices are kept, evaluation streams the test slices.
+    idx_train, idx_test = train_test_split(np.arange(len(slices)), test_size=N_TEST, random_state=SPLIT_SEED)
+
+    # Lung ROIs (cached next to the images), kept per test slice so evaluation pastes predictions back where they were.
+    if CROP_ROI:
+        roi_size = slices.compute_rois(margin=ROI_MARGIN)
+        print("Lung ROI:\t\t", roi_size[0], "x", roi_size[1], "({:.0%} of the slice area)".format(
+            roi_size[0] * roi_size[1] / float(slices.shape[0] * slices.shape[1])))
+
+    # Per-slice class histograms, for the foreground sampler. Test slice volumes, for per-volume metrics.
+    np.savez(out, idx_train=idx_train, idx_test=idx_test, classes=slices.classes, num_ims=len(slices),
+             histograms=slices.class_histograms(), test_origins=slices.origins(idx_test)
+             if CROP_ROI else np.zeros((len(idx_test), 2), dtype=np.int64), roi_size=slices.input_shape,
+             test_volumes=slices.volume_of[idx_test],
+             volume_names=np.array([os.path.basename(f) for f in slices.image_files]))
+
+
+# =============================================================
+# STEP: Compile and Fit Model.
+# =============================================================
+def stage_train(out, paths, args):
+    if args.weights:
+        shutil.copyfile(args.weights, out)
+        return
+
+    split, slices, test, paste = load_split(paths['prepare'])
+
+    # Stream the training split, with sparse or one-hot masks.
+    train_ds = make_dataset(slices, split['idx_train'], N_CLASSES, batch_size=BATCH_SIZE, shuffle=SHUFFLE,
+                            dtype=NORM_DTYPE, one_hot=not SPARSE_LABELS, sampler=get_sampler(split), crop=CROP_ROI)
+    test_ds = make_dataset(slices, split['idx_test'], N_CLASSES, batch_size=BATCH_SIZE, dtype=NORM_DTYPE,
+                           one_hot=not SPARSE_LABELS, crop=CROP_ROI)
+
+    model = get_model(slices.input_shape, slices.dtype.name)
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr=LEARNING_RATE), loss=LOSS,
+                  metrics=[IOU_METRIC(num_classes=N_CLASSES)])
+    model.fit(train_ds, verbose=VERBOSITY, epochs=EPOCHS, validation_data=test_ds, class_weight=CLASS_WEIGHTS)
+    model.save(out)
+
+    # EVAL: Multi-class Segmentation (UNet)
+    eval_unet(FNAME="un_metrics_temp", DATASET=DATASET, MODEL=model, BATCH=BATCH_SIZE, EPOCHS=EPOCHS, CLASSES=CLASSES,
+              NUM_IMS=int(split['num_ims']), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=test(BATCH_SIZE), PASTE=paste,
+              PRINT=True)
 
 
-# # =============================================================
-# # STEP: Compile and Fit Model.
-# # =============================================================
-# model = get_model()
-# model.compile(optimizer=OPTIMIZER, loss='categorical_crossentropy',
-#               metrics=[keras.metrics.MeanIoU(num_classes=N_CLASSES)])
-# history = model.fit(x_train, y_train_cat, batch_size=BATCH_SIZE, verbose=VERBOSITY, epochs=EPOCHS,
-#                     validation_data=(x_test, y_test_cat), class_weight=weights, shuffle=SHUFFLE)
-# model.save(dir_models + DATASET + ".hdf5")
-#
-# # EVAL: Multi-class Segmentation (UNet)
-# model.load_weights(dir_models + DATASET + ".hdf5")
-# eval_unet(FNAME="un_metrics_temp", DATASET=DATASET, MODEL=model, BATCH=BATCH_SIZE, EPOCHS=EPOCHS, CLASSES=CLASSES,
-#      NUM_IMS=len(TRAIN_IMAGS), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_IMS=x_test, TEST_MASKS=y_test, PRINT=True)
-#
 # # =============================================================
 # # STEP: Display Prediction.
 # # =============================================================
-# model = get_model()
+# split, slices, test, paste = load_split(<prepare artifact>)
+# x_test, y_test = next(test(64))
+# model = get_model(slices.input_shape, slices.dtype.name)
 # model.load_weights(dir_models + DATASET + ".hdf5")
 #
 # # Predict on a few images
@@ -212,87 +402,317 @@ def get_model():
 # =============================================================
 # STEP: Begin Pruning UNet
 # =============================================================
-model = get_model()
-model.load_weights(dir_models + DATASET + ".hdf5")
-model.compile(optimizer=OPTIMIZER, loss='categorical_crossentropy',
-              metrics=[tf.keras.metrics.MeanIoU(num_classes=N_CLASSES)])
-
-with open('metrics/un_summary_origin.txt', 'w') as f:
-    model.summary(print_fn=lambda x: f.write(x + '\n'))
-f.close()
-
-prune_low_magnitude = tfmot.sparsity.keras.prune_low_magnitude
-
-# Compute end step to finish pruning after 2 epochs.
-prune_epochs = 2
-validation_split = 0.1      # 10% of training set will be used for validation set.
-
-num_images = TRAIN_IMAGS.shape[0] * (1 - validation_split)
-end_step = np.ceil(num_images / BATCH_SIZE).astype(np.int32) * prune_epochs
-
-# Define model for pruning.
-pruning_params = {
-      'pruning_schedule': tfmot.sparsity.keras.PolynomialDecay(initial_sparsity=0.00,
-                                                               final_sparsity=0.50,
-                                                               begin_step=0,
-                                                               end_step=end_step)
-}
-model_for_pruning = prune_low_magnitude(model, **pruning_params)
-model_for_pruning.compile(optimizer=OPTIMIZER,
-                          loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-                          metrics=[tf.keras.metrics.MeanIoU(num_classes=N_CLASSES)])
-
-# Evaluate Pruned Model
-eval_unet(FNAME="un_metrics_pruned1", DATASET=DATASET, MODEL=model_for_pruning, CLASSES=CLASSES,
-          NUM_IMS=len(TRAIN_IMAGS), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_IMS=x_test, TEST_MASKS=y_test)
+def stage_prune(out, paths):
+    split, slices, test, paste = load_split(paths['prepare'])
+    model = get_model(slices.input_shape, slices.dtype.name)
+    model.load_weights(paths['train'])
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr=LEARNING_RATE), loss=LOSS,
+                  metrics=[IOU_METRIC(num_classes=N_CLASSES)])
+
+    with open('metrics/un_summary_origin.txt', 'w') as f:
+        model.summary(print_fn=lambda x: f.write(x + '\n'))
+    f.close()
+
+    prune_low_magnitude = tfmot.sparsity.keras.prune_low_magnitude
+
+    # Compute end step to finish pruning after 2 epochs.
+    num_images = int(split['num_ims']) * (1 - VALIDATION_SPLIT)
+    end_step = np.ceil(num_images / BATCH_SIZE).astype(np.int32) * PRUNE_EPOCHS
+
+    # Define model for pruning.
+    pruning_params = {
+          'pruning_schedule': tfmot.sparsity.keras.PolynomialDecay(initial_sparsity=0.00,
+                                                                   final_sparsity=FINAL_SPARSITY,
+                                                                   begin_step=0,
+                                                                   end_step=end_step)
+    }
+    model_for_pruning = prune_low_magnitude(model, **pruning_params)
+    model_for_pruning.compile(optimizer=tf.keras.optimizers.Adam(lr=LEARNING_RATE),
+                              loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                              metrics=[tf.keras.metrics.MeanIoU(num_classes=N_CLASSES)])
+
+    # Evaluate Pruned Model
+    eval_unet(FNAME="un_metrics_pruned1", DATASET=DATASET, MODEL=model_for_pruning, CLASSES=CLASSES,
+              NUM_IMS=int(split['num_ims']), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=test(), PASTE=paste)
+
+    # Export Pruned Model to hdf5
+    model_for_export = tfmot.sparsity.keras.strip_pruning(model_for_pruning)
+    model_for_export.save(out)
+    with open('metrics/un_summary_pruned.txt', 'w') as f:
+        model_for_export.summary(print_fn=lambda x: f.write(x + '\n'))
+    f.close()
+
+
+# =============================================================
+# STEP: Convert Pruned Model to TFlite (& Quantize)
+# =============================================================
+def center_tile(x):
+    """The (zero-padded) central TILE x TILE window of host-normalized slices: what a tile model takes."""
+    x = x if NORM_DTYPE else normalize_batch(x, dtype='float32', axis=1)
+    pad_h, pad_w = max(TILE - x.shape[1], 0), max(TILE - x.shape[2], 0)
+    x = np.pad(x, ((0, 0), (0, pad_h), (0, pad_w), (0, 0)))
+    y0, x0 = (x.shape[1] - TILE) // 2, (x.shape[2] - TILE) // 2
+    return x[:, y0:y0 + TILE, x0:x0 + TILE]
+
+
+def representative_data(split):
+    """Calibration inputs of the int8 export: N_REPRESENTATIVE training slices (ROIs, or tiles), one at a time."""
+    slices = SliceIndex(dir_data + dir_ims)
+    if CROP_ROI:
+        slices.compute_rois(margin=ROI_MARGIN)
+    idx_train = split['idx_train']
+    indices = np.random.RandomState(SPLIT_SEED).choice(idx_train, min(N_REPRESENTATIVE, len(idx_train)), replace=False)
+
+    def generate():
+        for i in indices:
+            x, _ = slices.batch([i], crop=CROP_ROI)
+            if NORM_DTYPE:
+                x = normalize_batch(x, dtype=NORM_DTYPE)
+            if TILE:
+                x = center_tile(x)
+            yield [x.astype(np.float32)]
+    return generate
+
+
+def stage_export(out, paths, mode='none'):
+    pruned_model = tf.keras.models.load_model(paths['prune'], custom_objects=CUSTOM_OBJECTS)
+    representative = representative_data(np.load(paths['prepare'])) if mode == 'int8' else None
+    if TILE:
+        tflite_model = export_tile_tflite(pruned_model, TILE, mode=mode, representative=representative,
+                                          io_dtype=INT8_IO)
+    else:
+        tflite_model = convert_tflite(pruned_model, mode=mode, representative=representative, io_dtype=INT8_IO)
+
+    with open(out, 'wb') as f:
+        f.write(tflite_model)
+    f.close()
+    print("Exported:\t\t", mode, "TFLite model ({:,.1f} KB)".format(len(tflite_model) / 1024.))
+
 
 # =============================================================
-# STEP: Export Pruned Model to hdf5
+# STEP: Quantization-Aware Training (Int8)
 # =============================================================
-model_for_export = tfmot.sparsity.keras.strip_pruning(model_for_pruning)
-model_for_export.save(dir_models + DATASET + "_pruned.hdf5")
-with open('metrics/un_summary_pruned.txt', 'w') as f:
-    model_for_export.summary(print_fn=lambda x: f.write(x + '\n'))
-f.close()
-print('SAVED:\t\t Pruned Keras Model')
-
-# EVAL: Re-Loaded Pruned Model (hdf5)
-pruned_model = tf.keras.models.load_model(dir_models + DATASET + "_pruned.hdf5")
-eval_unet(FNAME="un_metrics_pruned2", DATASET=DATASET, MODEL=pruned_model, CLASSES=CLASSES,
-          NUM_IMS=len(TRAIN_IMAGS), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_IMS=x_test, TEST_MASKS=y_test)
-print('EVALUATED:\t Pruned Keras Model')
+def stage_qat(out, paths):
+    split, slices, test, paste = load_split(paths['prepare'])
+
+    # Same batches as training, with float32 images: the fake-quant model's input is calibrated like any other tensor.
+    to_float = lambda images, masks: (tf.cast(images, tf.float32), masks)
+    train_ds = make_dataset(slices, split['idx_train'], N_CLASSES, batch_size=BATCH_SIZE, shuffle=SHUFFLE,
+                            dtype=NORM_DTYPE, one_hot=not SPARSE_LABELS, sampler=get_sampler(split),
+                            crop=CROP_ROI).map(to_float)
+    test_ds = make_dataset(slices, split['idx_test'], N_CLASSES, batch_size=BATCH_SIZE, dtype=NORM_DTYPE,
+                           one_hot=not SPARSE_LABELS, crop=CROP_ROI).map(to_float)
+
+    pruned_model = tf.keras.models.load_model(paths['prune'], custom_objects=CUSTOM_OBJECTS)
+    qat_model = quantize_unet(pruned_model)
+    qat_model.compile(optimizer=tf.keras.optimizers.Adam(lr=QAT_LEARNING_RATE), loss=LOSS,
+                      metrics=[IOU_METRIC(num_classes=N_CLASSES)])
+    qat_model.fit(train_ds, verbose=VERBOSITY, epochs=QAT_EPOCHS, validation_data=test_ds)
+
+    # EVAL: Fake-quant Keras model (what the int8 export should match).
+    eval_unet(FNAME="un_metrics_qat", DATASET=DATASET, MODEL=qat_model, CLASSES=CLASSES, NUM_IMS=int(split['num_ims']),
+              IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=((x.astype(np.float32), y) for x, y in test()), PASTE=paste)
+
+    # Tile exports: the fine-tuned weights & quantization ranges carry over to a tile-sized fake-quant copy.
+    if TILE:
+        qat_model = quantize_unet(tile_model(pruned_model, TILE), weights=qat_model.get_weights())
+    tflite_model = convert_tflite(qat_model, mode='int8', representative=representative_data(split), io_dtype=INT8_IO)
+
+    with open(out, 'wb') as f:
+        f.write(tflite_model)
+    f.close()
+    print("Exported:\t\t QAT int8 TFLite model ({:,.1f} KB)".format(len(tflite_model) / 1024.))
+
 
 # =============================================================
-# STEP: Convert Pruned Model to TFlite
+# STEP: Train Coarse Model (Coarse-to-Fine Inference)
 # =============================================================
-converter = lite.TFLiteConverter.from_keras_model(pruned_model)
-pruned_tflite_model = converter.convert()
+def stage_coarse(out, paths):
+    split = np.load(paths['prepare'])
+    slices = SliceIndex(dir_data + dir_ims, dir_data + dir_masks, packed_masks=True)
+    if CROP_ROI:
+        slices.compute_rois(margin=ROI_MARGIN)
+
+    # Same batches as the full model, zero-padded to the coarse model's size & shrunk: images by block mean (as
+    # seg_infer.downsample() does at inference), masks by keeping every COARSE_SCALE-th pixel.
+    height, width = coarse_shape(slices.input_shape, COARSE_SCALE)
+    pad = [[0, 0], [0, height * COARSE_SCALE - slices.input_shape[0]],
+           [0, width * COARSE_SCALE - slices.input_shape[1]], [0, 0]]
+
+    def shrink(images, masks):
+        images = tf.nn.avg_pool2d(tf.pad(tf.cast(images, tf.float32), pad), COARSE_SCALE, COARSE_SCALE, 'VALID')
+        return images, tf.pad(masks, pad)[:, ::COARSE_SCALE, ::COARSE_SCALE]
+
+    train_ds = make_dataset(slices, split['idx_train'], N_CLASSES, batch_size=BATCH_SIZE, shuffle=SHUFFLE,
+                            dtype=NORM_DTYPE, one_hot=False, sampler=get_sampler(split), crop=CROP_ROI).map(shrink)
+    test_ds = make_dataset(slices, split['idx_test'], N_CLASSES, batch_size=BATCH_SIZE, dtype=NORM_DTYPE,
+                           one_hot=False, crop=CROP_ROI).map(shrink)
+
+    model = get_coarse_model(slices.input_shape)
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr=LEARNING_RATE), loss='sparse_categorical_crossentropy',
+                  metrics=[SparseMeanIoU(num_classes=N_CLASSES)])
+    model.fit(train_ds, verbose=VERBOSITY, epochs=COARSE_EPOCHS, validation_data=test_ds)
+    model.save(out)
 
-filename = dir_models + DATASET + '_pruned.tflite'
-with open(filename, 'wb') as f:
-    f.write(pruned_tflite_model)
-f.close()
-print('SAVED:\t\t Pruned TFLite Model')
 
-# EVAL: Pruned TFLite File
-eval_tfl(pruned_tflite_model, FNAME="un_metrics_pruned_tfl", DATASET=DATASET, CLASSES=CLASSES, IM_SIZE=IM_SIZE,
-         X_TEST=x_test, Y_TEST=y_test)
-print("EVALUATED:\t Pruned TFLite Model")
+# =============================================================
+# STEP: Evaluate Pruned Models
+# =============================================================
+def tiled(predict_batch):
+    """Tiled predictor. Tiles are cut from whole, host-normalized slices (the tile models skip the L2)."""
+    preprocess = None if NORM_DTYPE else lambda x: normalize_batch(x, dtype='float32', axis=1)
+    return TiledPredictor(predict_batch, N_CLASSES, tile=TILE, overlap=TILE_OVERLAP, batch_size=TILE_BATCH,
+                          preprocess=preprocess)
+
+
+def eval_c2f(split, slices, test, paste, paths):
+    """Coarse-to-fine against full inference of the pruned model: compute skipped & mean IoU delta."""
+    pruned_model = tf.keras.models.load_model(paths['prune'], custom_objects=CUSTOM_OBJECTS)
+    coarse_model = tf.keras.models.load_model(paths['coarse'], custom_objects=CUSTOM_OBJECTS)
+    volumes, volume_names = test_volumes(split)
+
+    # Convolution cost grows with the pixel count, so a tile costs the slice's FLOPs scaled by its area.
+    fine_flops = conv_flops(pruned_model)
+    if TILE:
+        fine = tiled(keras_tiles(pruned_model, TILE))
+        fine_flops = fine_flops * TILE * TILE // (slices.input_shape[0] * slices.input_shape[1])
+    else:
+        fine = lambda x: np.argmax(pruned_model.predict_on_batch(x), axis=3)
+    c2f = CoarseToFine(lambda x: np.argmax(coarse_model.predict_on_batch(x), axis=3), fine, COARSE_SCALE,
+                       conv_flops(coarse_model), fine_flops, lesion_classes=range(1, N_CLASSES), margin=COARSE_MARGIN)
+
+    iou_full = eval_unet(FNAME="un_metrics_c2f_full", DATASET=DATASET, CLASSES=CLASSES, NUM_IMS=int(split['num_ims']),
+                         IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=test(), PASTE=paste,
+                         PREDICT=fine.predict if TILE else fine, VOLUMES=volumes,
+                         VOLUME_NAMES=volume_names)['mean_iou']
+    iou_c2f = eval_unet(FNAME="un_metrics_c2f", DATASET=DATASET, CLASSES=CLASSES, NUM_IMS=int(split['num_ims']),
+                        IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=test(), PASTE=paste, PREDICT=c2f.predict,
+                        VOLUMES=volumes, VOLUME_NAMES=volume_names)['mean_iou']
+    print("Coarse-to-fine:\t\t {:.1%} of the full-resolution compute skipped".format(c2f.skipped()))
+    print("Mean IoU:\t\t {:.4f} (full) -> {:.4f} (coarse-to-fine), delta {:+.4f}".format(
+        iou_full, iou_c2f, iou_c2f - iou_full))
+    return {'metrics': "un_metrics_c2f", 'skipped': c2f.skipped(), 'iou_full': iou_full, 'iou_c2f': iou_c2f,
+            'iou_delta': iou_c2f - iou_full}
+
+
+def stage_evaluate(out, paths, args):
+    split, slices, test, paste = load_split(paths['prepare'])
+    volumes, volume_names = test_volumes(split)
+    results = {}
+
+    # EVAL: Re-Loaded Pruned Model (hdf5)
+    if 'keras' in args.eval:
+        pruned_model = tf.keras.models.load_model(paths['prune'], custom_objects=CUSTOM_OBJECTS)
+        eval_unet(FNAME="un_metrics_pruned2", DATASET=DATASET, MODEL=pruned_model, CLASSES=CLASSES,
+                  NUM_IMS=int(split['num_ims']), IM_DIM=IM_SIZE, IM_CH=IM_CH, TEST_DS=test(), PASTE=paste,
+                  PREDICT=tiled(keras_tiles(pruned_model, TILE)).predict if TILE else None,
+                  VOLUMES=volumes, VOLUME_NAMES=volume_names)
+        results['keras'] = "un_metrics_pruned2"
+        print('EVALUATED:\t Pruned Keras Model')
+
+    # EVAL: Pruned TFLite Files (float32, dynamic-range, float16 & int8), with their size & latency.
+    for target in sorted(TFLITE_TARGETS):
+        if target not in args.eval:
+            continue
+        stage, fname, title = TFLITE_TARGETS[target]
+        with open(paths[stage], 'rb') as f:
+            tflite_model = f.read()
+        metrics = eval_tfl(tflite_model, FNAME=fname, DATASET=DATASET, CLASSES=CLASSES, IM_SIZE=IM_SIZE,
+                           TEST_DS=test(TFL_BATCH), PASTE=paste,
+                           PREDICT=tiled(tflite_tiles(tflite_model, batch_size=TILE_BATCH)).predict if TILE else None,
+                           VOLUMES=volumes, VOLUME_NAMES=volume_names, BATCH=TFL_BATCH, WORKERS=TFL_WORKERS,
+                           LATENCY_SAMPLE=center_tile(next(test(8))[0]) if TILE else None)
+        results[target] = {'metrics': fname, 'mode': QUANT_STAGES.get(stage, stage), 'mean_iou': metrics['mean_iou'],
+                           'size_kb': metrics['size_kb'], 'latency_ms': metrics['latency_ms'],
+                           'slices_per_s': metrics['slices_per_s']}
+        print("EVALUATED:\t", title)
+
+    # Side by side, to pick a deployment target from.
+    compared = [target for target in sorted(TFLITE_TARGETS) if target in results]
+    if compared:
+        print("Variant\t\t Size (KB)\t Latency (ms" + (", per tile" if TILE else "") + ")\t Slices/s\t Mean IoU")
+        for target in compared:
+            r = results[target]
+            print("{:<8}\t {:>9,.1f}\t {:>8.2f}\t {:>8.2f}\t {:.4f}".format(
+                r['mode'], r['size_kb'], r['latency_ms'], r['slices_per_s'], r['mean_iou']))
+
+    # EVAL: Coarse-to-Fine (Pruned Keras Model)
+    if 'c2f' in args.eval:
+        results['c2f'] = eval_c2f(split, slices, test, paste, paths)
+        print("EVALUATED:\t Coarse-to-Fine Inference")
+
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+
 
 # =============================================================
-# STEP: Quantize Pruned File
+# STEP: Stage Runner
 # =============================================================
-converter = lite.TFLiteConverter.from_keras_model(pruned_model)
-converter.optimizations = [tf.lite.Optimize.DEFAULT]
-prune_quant_tfl_model = converter.convert()                # Weights are quantized now.
-
-filename = dir_models + DATASET + '_pq.tflite'
-with open(filename, 'wb') as f:
-    f.write(prune_quant_tfl_model)
-f.close()
-print("SAVED:\t\t Pruned & Quantized TFLite Model")
-
-# EVAL: Pruned and Quantized File
-eval_tfl(prune_quant_tfl_model, FNAME="un_metrics_pq_tfl", DATASET=DATASET, CLASSES=CLASSES, IM_SIZE=IM_SIZE,
-         X_TEST=x_test, Y_TEST=y_test)
-print("EVALUATED:\t Pruned & Quantized TFLite Model")
+def run_stage(stage, paths, args):
+    # Written under a temporary name first, so an interrupted stage never leaves a valid-looking artifact.
+    out = paths[stage]
+    tmp = out[:-len(EXTENSIONS[stage])] + '.tmp' + EXTENSIONS[stage]
+    if stage == 'prepare':
+        stage_prepare(tmp, paths)
+    elif stage == 'train':
+        stage_train(tmp, paths, args)
+    elif stage == 'prune':
+        stage_prune(tmp, paths)
+    elif stage in QUANT_STAGES:
+        stage_export(tmp, paths, QUANT_STAGES[stage])
+    elif stage == 'qat':
+        stage_qat(tmp, paths)
+    elif stage == 'coarse':
+        stage_coarse(tmp, paths)
+    elif stage == 'evaluate':
+        stage_evaluate(tmp, paths, args)
+    os.replace(tmp, out)
+
+    if stage in PUBLISHED:
+        shutil.copyfile(out, dir_models + PUBLISHED[stage])
+    print('SAVED:\t\t', stage, '->', out)
+
+
+def run(stages, args):
+    os.makedirs(dir_stages, exist_ok=True)
+    keys = stage_keys(args)
+    paths = {stage: dir_stages + stage + '-' + keys[stage] + EXTENSIONS[stage] for stage in STAGES + OPTIONAL_STAGES}
+    done = set()
+
+    def build(stage, requested):
+        if stage in done:
+            return
+        for dep in depends_on(stage, args):
+            build(dep, False)
+        if os.path.exists(paths[stage]) and not (args.force and requested):
+            print('SKIPPED:\t', stage, '(unchanged, ' + paths[stage] + ')')
+        else:
+            run_stage(stage, paths, args)
+        done.add(stage)
+
+    for stage in stages:
+        build(stage, True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train, prune, convert & evaluate the U-Net, one cached stage at '
+                                                 'a time.')
+    # NOTE: No choices on the positional: argparse would check the whole default list against them as one value.
+    parser.add_argument('stages', nargs='*', default=None,
+                        help="Stages to run (default: all). Missing inputs are built first. One of: " +
+                             ', '.join(STAGES + OPTIONAL_STAGES))
+    parser.add_argument('--weights', default=None,
+                        help="Already trained weights (e.g. seg_models/MedSeg.hdf5) to use instead of training")
+    parser.add_argument('--eval', nargs='+', choices=sorted(EVAL_TARGETS), default=DEFAULT_EVAL,
+                        help="Models to evaluate (default: " + ', '.join(DEFAULT_EVAL) + ")")
+    parser.add_argument('--force', action='store_true', help="Re-run the requested stages even if unchanged")
+    args = parser.parse_args()
+    unknown = [stage for stage in args.stages or [] if stage not in STAGES + OPTIONAL_STAGES]
+    if unknown:
+        parser.error("invalid stage(s): " + ', '.join(unknown) + " (choose from " +
+                     ', '.join(STAGES + OPTIONAL_STAGES) + ")")
+    args.stages = args.stages or STAGES
+
+    config = tf_v1.ConfigProto(device_count={'GPU': 1, 'CPU': 8})
+    K.set_session(tf_v1.Session(config=config))
+    run(args.stages, args)